@@ -243,6 +243,33 @@ const getMessagingConversations = (actions) => {
     return match ? parseInt(match.value || 0, 10) : 0;
 };
 
+// --- SINCRONIZACIÓN INCREMENTAL ---
+// Aplica una respuesta de /ads/sync: completa (delta=false) o solo cambios (delta=true)
+const mergeSync = (prev, json) => {
+    if (!json.delta) return json;
+    const changed = new Map((json.meta || []).map(ad => [ad.id, ad]));
+    const removed = new Set(json.meta_removed || []);
+    const meta = prev.meta
+        .filter(ad => !removed.has(ad.id))
+        .map(ad => changed.has(ad.id) ? changed.get(ad.id) : ad);
+    const known = new Set(meta.map(ad => ad.id));
+    changed.forEach((ad, id) => { if (!known.has(id)) meta.push(ad); });
+
+    const turns = json.turns_replace ? { ...json.turns } : { ...prev.turns, ...(json.turns || {}) };
+    Object.keys(turns).forEach(name => { if (turns[name] === null) delete turns[name]; });
+
+    return {
+        ...prev,
+        meta,
+        turns,
+        settings: { ...prev.settings, ...(json.settings || {}) },
+        holidays: json.holidays ?? prev.holidays,
+        automation_active: json.automation_active ?? prev.automation_active,
+        logs: json.logs ?? prev.logs,
+        version: json.version
+    };
+};
+
 // --- APLICACIÓN PRINCIPAL ---
 const Dashboard = ({ userEmail, onLogout }) => {
     const [data, setData] = useState({ meta: [], settings: {}, turns: {}, holidays: [], automation_active: false, logs: [] });
@@ -256,12 +283,23 @@ const Dashboard = ({ userEmail, onLogout }) => {
     const [searchQuery, setSearchQuery] = useState("");
     const [statusFilter, setStatusFilter] = useState("ALL"); // ALL | ACTIVE | PAUSED
 
+    // Cursor opaco del backend para pedir solo los cambios (delta) en cada sincronización
+    const versionRef = useRef(null);
+
     const fetchSync = useCallback(async (silent = false) => {
         if (!silent) setSyncing(true);
         try {
-            const res = await fetch(`${API_URL}/ads/sync`);
+            const version = versionRef.current;
+            const res = await fetch(
+                version !== null ? `${API_URL}/ads/sync?since=${encodeURIComponent(version)}` : `${API_URL}/ads/sync`,
+                { headers: version !== null ? { 'If-None-Match': `"${version}"` } : {} }
+            );
+            if (res.status === 304) return;
             const json = await res.json();
-            if (json) setData(json);
+            if (json) {
+                versionRef.current = json.version ?? null;
+                setData(prev => mergeSync(prev, json));
+            }
         } catch (e) { 
             console.error("Sync Error", e); 
         } finally { 
@@ -269,10 +307,35 @@ const Dashboard = ({ userEmail, onLogout }) => {
         }
     }, []);
 
+    // Canal push: el backend envía cada cambio como diff; el polling queda solo como respaldo
+    const streamRef = useRef(null);
+
     useEffect(() => {
-        fetchSync();
-        const interval = setInterval(() => fetchSync(true), 25000);
-        return () => clearInterval(interval);
+        let retry = null;
+        const connect = () => {
+            const version = versionRef.current;
+            const source = new EventSource(version !== null ? `${API_URL}/ads/stream?since=${encodeURIComponent(version)}` : `${API_URL}/ads/stream`);
+            streamRef.current = source;
+            source.onmessage = (e) => {
+                const json = JSON.parse(e.data);
+                versionRef.current = json.version ?? null;
+                setData(prev => mergeSync(prev, json));
+            };
+            source.onerror = () => {
+                // Reconecta desde el último cursor para recibir solo lo que se perdió
+                source.close();
+                retry = setTimeout(connect, 5000);
+            };
+        };
+        connect();
+        const interval = setInterval(() => {
+            if (!streamRef.current || streamRef.current.readyState !== EventSource.OPEN) fetchSync(true);
+        }, 25000);
+        return () => {
+            clearInterval(interval);
+            clearTimeout(retry);
+            if (streamRef.current) streamRef.current.close();
+        };
     }, [fetchSync]);
 
     const handleBulkAction = async () => {
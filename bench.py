@@ -0,0 +1,272 @@
+"""Benchmarks del backend contra la Graph API simulada (mock_graph.py).
+
+Levanta en el mismo proceso el servidor simulado y main.py (apuntado a él con META_GRAPH_URL y una
+SQLite temporal) y mide:
+  - tick del motor: evaluate_adsets con caché caliente (solo reglas) y caché frío (incluye descarga)
+  - fan-out en frontera de turno: todos los AdSets cambian de estado en un mismo tick
+  - /ads/sync p50/p99 con N clientes concurrentes, completo y en delta (since=)
+  - crecimiento de memoria (tracemalloc) durante una corrida larga de ticks, cambios y sync
+
+Uso:
+    python bench.py --adsets 200 --ads 5 --latency-ms 50 --clients 20 --duration 10
+    python bench.py --json > bench_output.txt
+
+El coordinador de workers no se arranca: el motor se invoca directamente para medir cada tick
+sin que el motor real compita por los mismos AdSets.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+import tracemalloc
+from datetime import datetime
+
+import httpx
+import uvicorn
+
+import mock_graph
+
+def percentiles(samples):
+    """{n, p50, p99, max} en milisegundos"""
+    if not samples: return {"n": 0, "p50": 0.0, "p99": 0.0, "max": 0.0}
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {"n": len(ordered), "p50": round(pick(0.50), 2), "p99": round(pick(0.99), 2), "max": round(ordered[-1], 2)}
+
+def serve(app, port):
+    """Corre una app ASGI en un hilo propio y espera a que acepte conexiones"""
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="error", lifespan="on"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive(): raise RuntimeError(f"No arrancó el servidor en el puerto {port}")
+        time.sleep(0.05)
+    return server, thread
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.results = {}
+        self.tmp = tempfile.mkdtemp(prefix="metahandle-bench-")
+        self.mock_url = f"http://127.0.0.1:{args.mock_port}"
+        self.api_url = f"http://127.0.0.1:{args.api_port}"
+        self.loop = None
+
+    # --- Arranque ---
+    def start(self):
+        a = self.args
+        self.mock_app = mock_graph.create_app(adsets=a.adsets, ads=a.ads, latency_ms=a.latency_ms,
+                                              error_rate=a.error_rate, usage=a.usage)
+        self.mock_server, _ = serve(self.mock_app, a.mock_port)
+
+        # main.py lee su configuración al importarse
+        os.environ.update({
+            "DATABASE_URL": f"sqlite:///{os.path.join(self.tmp, 'bench.db')}",
+            "META_GRAPH_URL": self.mock_url, "META_AD_ACCOUNT_ID": "act_mock", "META_ACCESS_TOKEN": "bench",
+        })
+        import main
+        self.main = main
+        main.ENV_FILE = os.path.join(self.tmp, ".env")
+        main.ALLOWED_IDS[:] = mock_graph.adset_ids(a.adsets)
+
+        async def idle():
+            pass
+
+        async def capture_loop():
+            self.loop = asyncio.get_running_loop()
+
+        main.cluster_coordinator = idle
+        main.app.add_event_handler("startup", capture_loop)
+        self.api_server, _ = serve(main.app, a.api_port)
+        self.on_api(self.configure())
+
+    def stop(self):
+        for server in (self.api_server, self.mock_server):
+            server.should_exit = True
+        time.sleep(0.5)
+
+    def on_api(self, coro):
+        """Ejecuta una corrutina en el event loop del backend y espera su resultado"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def mock(self, path, payload):
+        return httpx.post(f"{self.mock_url}{path}", json=payload).json()
+
+    async def configure(self):
+        """Todos los AdSets simulados en un turno de 24h y la automatización encendida"""
+        main = self.main
+
+        def work(db):
+            if not db.query(main.TurnConfig).filter_by(name="bench").first():
+                db.add(main.TurnConfig(name="bench", start_hour=0.0, end_hour=24.0, days="L,M,X,J,V,S,D"))
+            db.query(main.AdSetSetting).filter(main.AdSetSetting.id.in_(main.ALLOWED_IDS)).update(
+                {"turno": "bench", "limit_perc": 100.0, "is_frozen": False}, synchronize_session=False)
+            db.query(main.AutomationState).update({"is_active": True})
+            db.commit()
+        await main.run_db(work)
+        await main.rebuild_schedule(broadcast=False)
+
+    async def expire_cache(self):
+        """Vence el caché local y el snapshot compartido para que el siguiente acceso descargue de Meta"""
+        main = self.main
+        for part in main.meta_cache["parts"].values(): part["timestamp"] = 0
+        main.meta_cache["timestamp"] = 0
+        await main.run_db(main.write_snapshot, "meta_parts", "")
+
+    async def refresh_cache(self):
+        """Fuerza una descarga completa de los tres grupos de campos"""
+        await self.expire_cache()
+        await self.main._refresh_meta_cache()
+
+    # --- Mediciones ---
+    def bench_tick(self):
+        main, samples_warm, samples_cold = self.main, [], []
+
+        async def run():
+            await self.refresh_cache()
+            for _ in range(self.args.ticks):
+                started = time.perf_counter()
+                await main.evaluate_adsets(datetime.now(main.MEX_TZ))
+                samples_warm.append((time.perf_counter() - started) * 1000)
+            for _ in range(self.args.cold_ticks):
+                await self.expire_cache()
+                started = time.perf_counter()
+                await main.evaluate_adsets(datetime.now(main.MEX_TZ))
+                samples_cold.append((time.perf_counter() - started) * 1000)
+        self.on_api(run())
+        self.results["engine_tick_warm_ms"] = percentiles(samples_warm)
+        self.results["engine_tick_cold_ms"] = percentiles(samples_cold)
+
+    def bench_fanout(self):
+        """Todos los AdSets pausados en Meta y en turno: un tick debe encenderlos todos"""
+        main, samples, writes = self.main, [], []
+        for _ in range(self.args.fanout_rounds):
+            self.mock("/_mock/reset", {"status": "PAUSED"})
+            self.on_api(self.refresh_cache())
+
+            async def tick():
+                started = time.perf_counter()
+                await main.evaluate_adsets(datetime.now(main.MEX_TZ))
+                return (time.perf_counter() - started) * 1000
+            samples.append(self.on_api(tick()))
+            stats = httpx.get(f"{self.mock_url}/_mock/stats").json()
+            writes.append(stats.get("writes", 0))
+        self.results["shift_fanout_ms"] = dict(percentiles(samples), adsets=self.args.adsets, writes=writes)
+
+    async def _sync_clients(self, delta, duration):
+        """Clientes concurrentes consultando /ads/sync; en delta cada uno manda su último cursor"""
+        samples, statuses = [], {}
+        deadline = time.monotonic() + duration
+        async with httpx.AsyncClient(base_url=self.api_url, timeout=30) as client:
+            async def worker():
+                version = None
+                while time.monotonic() < deadline:
+                    params = {"since": version} if delta and version else None
+                    started = time.perf_counter()
+                    res = await client.get("/ads/sync", params=params)
+                    samples.append((time.perf_counter() - started) * 1000)
+                    statuses[res.status_code] = statuses.get(res.status_code, 0) + 1
+                    if res.status_code == 200: version = res.json().get("version")
+            await asyncio.gather(*(worker() for _ in range(self.args.clients)))
+        return samples, statuses
+
+    def _churn(self, stop):
+        """Cambios continuos mientras corren los clientes: journal, bitácora y snapshots de Meta"""
+        main = self.main
+        while not stop.wait(self.args.churn_interval):
+            adset_id = random.choice(main.ALLOWED_IDS)
+            self.loop.call_soon_threadsafe(main.mark_changed, "meta", adset_id)
+            self.loop.call_soon_threadsafe(main.log_action, "Bench", f"Cambio simulado en {adset_id}", adset_id)
+
+    def bench_sync(self):
+        for mode, delta in (("full", False), ("delta", True)):
+            stop = threading.Event()
+            churn = threading.Thread(target=self._churn, args=(stop,), daemon=True)
+            churn.start()
+            samples, statuses = asyncio.run(self._sync_clients(delta, self.args.duration))
+            stop.set(); churn.join()
+            self.results[f"sync_{mode}_ms"] = dict(percentiles(samples), clients=self.args.clients,
+                                                   rps=round(len(samples) / self.args.duration, 1), statuses=statuses)
+
+    def bench_memory(self):
+        """Crecimiento de memoria entre el final del calentamiento y el final de la corrida larga"""
+        main = self.main
+
+        async def soak(seconds):
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                await main.evaluate_adsets(datetime.now(main.MEX_TZ))
+                adset_id = random.choice(main.ALLOWED_IDS)
+                main.mark_changed("meta", adset_id)
+                main.log_action("Bench", f"Cambio simulado en {adset_id}", adset_id)
+                await main.sync_payload(main.meta_cache["data"] or [], None)
+                await asyncio.sleep(0.01)
+
+        tracemalloc.start()
+        self.on_api(soak(min(5, self.args.soak)))
+        before = tracemalloc.take_snapshot()
+        self.on_api(soak(self.args.soak))
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        growth = sum(s.size_diff for s in after.compare_to(before, "filename"))
+        top = [f"{s.traceback[0].filename.rsplit('/', 1)[-1]}:{s.traceback[0].lineno} {s.size_diff / 1024:+.1f} KiB"
+               for s in after.compare_to(before, "lineno")[:5]]
+        self.results["memory"] = {
+            "soak_s": self.args.soak, "growth_kib": round(growth / 1024, 1),
+            "max_rss_mib": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), "top": top,
+        }
+
+    def run(self):
+        self.start()
+        try:
+            self.bench_tick()
+            self.bench_fanout()
+            self.bench_sync()
+            self.bench_memory()
+            self.results["meta_calls"] = httpx.get(f"{self.mock_url}/_mock/stats").json()
+        finally:
+            self.stop()
+        return self.results
+
+def print_report(results):
+    for name, r in results.items():
+        if name == "meta_calls":
+            print(f"{'meta_calls':<22} " + " ".join(f"{k}={v}" for k, v in r.items() if k not in ("config", "usage_pct")))
+        elif name == "memory":
+            print(f"{'memory':<22} +{r['growth_kib']} KiB en {r['soak_s']}s  max_rss={r['max_rss_mib']} MiB")
+            for line in r["top"]: print(f"{'':<24}{line}")
+        else:
+            extra = " ".join(f"{k}={v}" for k, v in r.items() if k not in ("n", "p50", "p99", "max"))
+            print(f"{name:<22} n={r['n']:<6} p50={r['p50']:<9} p99={r['p99']:<9} max={r['max']:<9} {extra}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks de MetaHandle contra la Graph API simulada")
+    parser.add_argument("--adsets", type=int, default=200)
+    parser.add_argument("--ads", type=int, default=5)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--usage", type=float, default=10.0, help="%% de uso que reporta el mock en X-App-Usage")
+    parser.add_argument("--ticks", type=int, default=500, help="Ticks del motor con caché caliente")
+    parser.add_argument("--cold-ticks", type=int, default=5, help="Ticks del motor forzando descarga de Meta")
+    parser.add_argument("--fanout-rounds", type=int, default=3)
+    parser.add_argument("--clients", type=int, default=20, help="Clientes concurrentes de /ads/sync")
+    parser.add_argument("--duration", type=float, default=10.0, help="Segundos por modo de /ads/sync")
+    parser.add_argument("--churn-interval", type=float, default=0.1, help="Segundos entre cambios simulados")
+    parser.add_argument("--soak", type=float, default=30.0, help="Segundos de la corrida larga de memoria")
+    parser.add_argument("--mock-port", type=int, default=8900)
+    parser.add_argument("--api-port", type=int, default=8901)
+    parser.add_argument("--json", action="store_true", help="Imprime los resultados como JSON")
+    parser.add_argument("--verbose", action="store_true", help="Muestra los logs del backend")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    results = Bench(args).run()
+    if args.json: json.dump(results, sys.stdout, indent=2)
+    else: print_report(results)
@@ -2,15 +2,29 @@ import os
 import asyncio
 import httpx
 import base64
+import hmac
+import hashlib
 import json
+import re
 import pytz
 import logging
 import time
-from datetime import datetime
-from typing import Dict, Any
-from fastapi import FastAPI, HTTPException
+import bisect
+import heapq
+import random
+import itertools
+import importlib.util
+import socket
+import uuid
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, Any, Optional
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine, Column, String, Float, Boolean, Integer, DateTime
+from sqlalchemy import create_engine, event, inspect, insert, text, or_, Column, String, Float, Boolean, Integer, DateTime, Index, Text
+from sqlalchemy.exc import DBAPIError, IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from google.oauth2 import service_account
@@ -19,19 +33,144 @@ from dotenv import load_dotenv, dotenv_values
 
 load_dotenv()
 
+ENV_FILE = ".env"
+CONFIG_CHECK_INTERVAL = 1.0  # Segundos mínimos entre revisiones del mtime de .env
+
+# Snapshot de .env: se vuelve a parsear solo cuando cambia el archivo (rotación de token sin reinicio)
+config_snapshot: Dict[str, Any] = {"values": {}, "mtime": None, "checked": 0.0}
+
+def get_config():
+    """Valores actuales de .env. Un stat como máximo por segundo; el parseo solo ocurre si cambió el mtime."""
+    now = time.monotonic()
+    if now - config_snapshot["checked"] >= CONFIG_CHECK_INTERVAL:
+        config_snapshot["checked"] = now
+        try:
+            mtime = os.stat(ENV_FILE).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != config_snapshot["mtime"]:
+            config_snapshot["values"] = dotenv_values(ENV_FILE) if mtime is not None else {}
+            config_snapshot["mtime"] = mtime
+    return config_snapshot["values"]
+
 def get_meta_token():
-    """Lee el token dinámicamente del .env para no requerir reinicios del sistema"""
-    config = dotenv_values(".env")
-    return config.get("META_ACCESS_TOKEN", os.environ.get("META_ACCESS_TOKEN", "")).strip()
+    """Token de Meta desde el snapshot de .env para no requerir reinicios del sistema"""
+    return (get_config().get("META_ACCESS_TOKEN", os.environ.get("META_ACCESS_TOKEN", "")) or "").strip()
 
 def get_meta_ad_account_id():
-    """Lee el ID de la cuenta publicitaria dinámicamente"""
-    config = dotenv_values(".env")
-    return config.get("META_AD_ACCOUNT_ID", os.environ.get("META_AD_ACCOUNT_ID", "")).strip()
+    """ID de la cuenta publicitaria desde el snapshot de .env"""
+    return (get_config().get("META_AD_ACCOUNT_ID", os.environ.get("META_AD_ACCOUNT_ID", "")) or "").strip()
+
+class MetaAuth(httpx.Auth):
+    """Agrega el token vigente como header Authorization a cada petición hacia Graph"""
+    def auth_flow(self, request):
+        # Las URLs `paging.next` de Graph ya traen su propio access_token
+        if "access_token" not in request.url.params:
+            request.headers["Authorization"] = f"Bearer {get_meta_token()}"
+        yield request
+
+# --- MÉTRICAS (formato de texto Prometheus, sin dependencias) ---
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRICS_COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500)
+LOOP_LAG_INTERVAL = 0.5     # Segundos entre muestras del retraso del event loop
+
+METRICS_HELP = {
+    "metahandle_engine_tick_seconds": ("histogram", "Duración de cada etapa de un ciclo del motor (loop=schedule|spend)"),
+    "metahandle_engine_transitions": ("histogram", "Transiciones de estado decididas por ciclo del motor"),
+    "metahandle_engine_transitions_total": ("counter", "Cambios de estado enviados por el motor, por estado y resultado"),
+    "metahandle_meta_request_seconds": ("histogram", "Latencia de peticiones HTTP a Graph por endpoint"),
+    "metahandle_meta_queue_seconds": ("histogram", "Espera en el token bucket antes de salir hacia Graph"),
+    "metahandle_meta_errors_total": ("counter", "Respuestas fallidas de Graph por endpoint y tipo"),
+    "metahandle_meta_usage_percent": ("gauge", "Uso de cuota más alto reportado por los headers de Meta"),
+    "metahandle_meta_rate": ("gauge", "Peticiones por segundo permitidas ahora por el token bucket"),
+    "metahandle_meta_queue_length": ("gauge", "Peticiones esperando turno en el cliente de Meta"),
+    "metahandle_meta_cache_requests_total": ("counter", "Consultas al caché de Meta por resultado"),
+    "metahandle_meta_cache_refreshes_total": ("counter", "Descargas del snapshot de Meta"),
+    "metahandle_meta_cache_refresh_errors_total": ("counter", "Descargas del snapshot de Meta que fallaron"),
+    "metahandle_meta_cache_hit_ratio": ("gauge", "Fracción de consultas al caché servidas sin esperar a Meta"),
+    "metahandle_meta_cache_age_seconds": ("gauge", "Antigüedad de cada grupo de campos en caché"),
+    "metahandle_db_seconds": ("histogram", "Duración de operaciones en el pool de DB, incluida la espera por hilo"),
+    "metahandle_event_loop_lag_seconds": ("histogram", "Retraso del event loop respecto a un temporizador"),
+    "metahandle_log_buffer_entries": ("gauge", "Entradas de bitácora pendientes de insertar"),
+    "metahandle_stream_subscribers": ("gauge", "Clientes conectados al canal SSE"),
+    "metahandle_automation_active": ("gauge", "1 si la automatización está encendida"),
+    "metahandle_engine_leader": ("gauge", "1 si este worker corre el motor"),
+}
+
+# (nombre, etiquetas ordenadas) -> valor o histograma {bounds, counts, sum, count}
+metrics: Dict[str, Any] = {"counters": defaultdict(float), "histograms": {}}
+
+def inc(name, value=1, **labels):
+    metrics["counters"][(name, tuple(sorted(labels.items())))] += value
+
+def observe(name, value, buckets=METRICS_BUCKETS, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    h = metrics["histograms"].get(key)
+    if h is None:
+        h = metrics["histograms"][key] = {"bounds": buckets, "counts": [0] * (len(buckets) + 1), "sum": 0.0, "count": 0}
+    h["counts"][bisect.bisect_left(h["bounds"], value)] += 1
+    h["sum"] += value
+    h["count"] += 1
+
+def observe_since(name, started, **labels):
+    """Registra el tiempo transcurrido desde `started` y regresa el instante actual para encadenar etapas"""
+    now = time.perf_counter()
+    observe(name, now - started, **labels)
+    return now
+
+def _format_labels(labels):
+    if not labels: return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+def render_metrics(samples):
+    """Exposición de texto 0.0.4: contadores e histogramas acumulados más `samples` [(nombre, etiquetas, valor)] del momento"""
+    series = defaultdict(list)
+    for (name, labels), value in metrics["counters"].items():
+        series[name].append(f"{name}{_format_labels(labels)} {value:.10g}")
+    for (name, labels), h in metrics["histograms"].items():
+        cumulative = 0
+        for bound, count in zip(h["bounds"] + ("+Inf",), h["counts"]):
+            cumulative += count
+            le = bound if bound == "+Inf" else f"{bound:g}"
+            series[name].append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+        series[name].append(f"{name}_sum{_format_labels(labels)} {h['sum']:.6f}")
+        series[name].append(f"{name}_count{_format_labels(labels)} {h['count']}")
+    for name, labels, value in samples:
+        series[name].append(f"{name}{_format_labels(tuple(sorted(labels.items())))} {value:.10g}")
+    lines = []
+    for name in sorted(series):
+        kind, help_text = METRICS_HELP.get(name, ("untyped", ""))
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"] + series[name]
+    return "\n".join(lines) + "\n"
+
+async def loop_lag_monitor():
+    """Mide cuánto se atrasa un temporizador: si el loop está bloqueado (CPU o llamadas síncronas) el retraso crece"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        observe("metahandle_event_loop_lag_seconds", max(time.perf_counter() - started - LOOP_LAG_INTERVAL, 0.0))
 
 # --- 1. CONFIGURACIÓN DB Y MODELOS ---
-DATABASE_URL = "sqlite:///./meta_control.db"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+# SQLite local por defecto; DATABASE_URL permite apuntar a Postgres para correr varios workers
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./meta_control.db").replace("postgres://", "postgresql://", 1)
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "4"))
+
+if DATABASE_URL.startswith("sqlite"):
+    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False, "timeout": 15})
+
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_conn, _):
+        """WAL: lecturas concurrentes mientras otro hilo escribe, commits sin fsync por transacción"""
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute("PRAGMA busy_timeout=15000")
+        cur.execute("PRAGMA cache_size=-16000")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        cur.close()
+else:
+    engine = create_engine(DATABASE_URL, pool_size=DB_POOL_SIZE, max_overflow=DB_POOL_SIZE, pool_pre_ping=True)
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -63,18 +202,202 @@ class AutomationState(Base):
     is_active = Column(Boolean, default=False)
 
 class ActionLog(Base):
-    """Registro de acciones manuales y automáticas"""
+    """Registro de acciones manuales y automáticas (solo se agrega, nunca se edita)"""
     __tablename__ = "action_logs"
+    __table_args__ = (
+        Index("ix_action_logs_time", "time"),
+        Index("ix_action_logs_user_id", "user", "id"),
+        Index("ix_action_logs_adset_id_id", "adset_id", "id"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     user = Column(String)
     msg = Column(String)
     time = Column(DateTime, default=datetime.utcnow)
+    adset_id = Column(String, nullable=True)
+    reason = Column(String, nullable=True)
+
+class ClusterLease(Base):
+    """Arrendamientos entre workers: solo el titular vigente ejecuta la tarea (motor, descarga de Meta)"""
+    __tablename__ = "cluster_leases"
+    name = Column(String, primary_key=True)
+    holder = Column(String)
+    expires_at = Column(Float, default=0.0)
+
+class SharedSnapshot(Base):
+    """Datos compartidos entre workers (snapshot de Meta, sello de configuración)"""
+    __tablename__ = "shared_snapshots"
+    key = Column(String, primary_key=True)
+    data = Column(Text, default="")
+    updated_at = Column(Float, default=0.0)
 
-Base.metadata.create_all(bind=engine)
+# Con --workers N todos los procesos crean/migran/siembran a la vez: el que pierde la carrera recibe
+# "table already exists", "duplicate column" o IntegrityError y vuelve a intentar, ya viendo lo que hizo el otro
+DB_SETUP_RETRIES = 5
+
+def run_db_setup(fn, *args):
+    """Ejecuta un paso de arranque idempotente reintentando si otro worker lo hizo al mismo tiempo"""
+    for attempt in range(DB_SETUP_RETRIES):
+        try:
+            return fn(*args)
+        except DBAPIError as e:
+            if attempt == DB_SETUP_RETRIES - 1: raise
+            logging.warning(f"Arranque de DB concurrente en {fn.__name__} ({type(e.orig).__name__}), reintento {attempt + 1}")
+            time.sleep(random.uniform(0.05, 0.25) * (attempt + 1))
+
+def migrate_schema():
+    """Agrega columnas e índices nuevos a bases creadas por versiones anteriores"""
+    columns = {c["name"] for c in inspect(engine).get_columns("action_logs")}
+    with engine.begin() as conn:
+        for name in ("adset_id", "reason"):
+            if name not in columns:
+                conn.execute(text(f"ALTER TABLE action_logs ADD COLUMN {name} VARCHAR"))
+    for index in ActionLog.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+
+run_db_setup(Base.metadata.create_all, engine)
+run_db_setup(migrate_schema)
+
+# Todas las consultas corren en este pool para no bloquear el event loop
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+async def run_db(fn, *args):
+    """Ejecuta fn(db, *args) con su propia sesión en el pool de DB. fn debe regresar datos planos, no modelos."""
+    def work():
+        db = SessionLocal()
+        try: return fn(db, *args)
+        finally: db.close()
+    started = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(db_executor, work)
+    finally:
+        # Los endpoints pasan closures llamadas `work`: el qualname ("update_setting.work") las distingue
+        observe_since("metahandle_db_seconds", started, op=getattr(fn, "__qualname__", "db").replace(".<locals>", ""))
+
+# Bitácora con buffer: las acciones se encolan en memoria y se insertan por lotes fuera de la petición
+LOG_FLUSH_INTERVAL = 1.0    # Segundos máximos que una entrada espera en el buffer
+LOG_FLUSH_SIZE = 200        # Entradas que fuerzan un flush inmediato
+log_buffer: list = []
+log_flush_needed = asyncio.Event()
+
+def log_action(user, msg, adset_id=None, reason=None):
+    """Encola una entrada de bitácora sin tocar la DB"""
+    log_buffer.append({"user": user, "msg": msg, "adset_id": adset_id, "reason": reason, "time": datetime.utcnow()})
+    if len(log_buffer) >= LOG_FLUSH_SIZE: log_flush_needed.set()
+
+def _insert_logs(db, rows):
+    db.execute(insert(ActionLog), rows)
+    db.commit()
+
+async def flush_logs():
+    """Inserta todo lo pendiente en un solo INSERT; si falla, las entradas regresan al buffer"""
+    if not log_buffer: return
+    rows = log_buffer[:]
+    del log_buffer[:len(rows)]
+    try:
+        await run_db(_insert_logs, rows)
+    except Exception as e:
+        log_buffer[:0] = rows
+        logging.error(f"Error guardando bitácora: {e}")
+        return
+    mark_changed("logs")
+
+async def log_flusher():
+    while True:
+        try:
+            await asyncio.wait_for(log_flush_needed.wait(), LOG_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        log_flush_needed.clear()
+        await flush_logs()
+
+# --- COORDINACIÓN ENTRE WORKERS ---
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+LEASE_TTL = 15              # Segundos que dura el liderazgo sin renovarse
+CLUSTER_POLL = 5            # Segundos entre renovaciones y revisión de cambios de otros workers
+
+def try_acquire_lease(db, name, ttl):
+    """Toma o renueva el arrendamiento `name` si está libre, vencido o ya es nuestro. UPDATE atómico."""
+    now = time.time()
+    updated = db.query(ClusterLease).filter(
+        ClusterLease.name == name, or_(ClusterLease.holder == WORKER_ID, ClusterLease.expires_at < now)
+    ).update({"holder": WORKER_ID, "expires_at": now + ttl}, synchronize_session=False)
+    if updated:
+        db.commit()
+        return True
+    if db.query(ClusterLease).filter_by(name=name).first():
+        db.rollback()
+        return False
+    db.add(ClusterLease(name=name, holder=WORKER_ID, expires_at=now + ttl))
+    try:
+        db.commit()
+        return True
+    except IntegrityError:
+        # Otro worker creó la fila al mismo tiempo
+        db.rollback()
+        return False
+
+def release_lease(db, name):
+    db.query(ClusterLease).filter_by(name=name, holder=WORKER_ID).update({"expires_at": 0.0}, synchronize_session=False)
+    db.commit()
+
+def read_snapshot(db, key):
+    row = db.get(SharedSnapshot, key)
+    return (row.data, row.updated_at) if row else (None, 0.0)
+
+def write_snapshot(db, key, data=""):
+    row = db.get(SharedSnapshot, key)
+    if not row: row = SharedSnapshot(key=key); db.add(row)
+    row.data, row.updated_at = data, time.time()
+    db.commit()
+    return row.updated_at
+
+cluster_state: Dict[str, Any] = {"leader": False, "tasks": [], "config_seen": 0.0, "last_log_id": None}
+
+def _cluster_stamps(db):
+    _, config_stamp = read_snapshot(db, "config")
+    last_log = db.query(ActionLog.id).order_by(ActionLog.id.desc()).first()
+    return config_stamp, last_log[0] if last_log else 0
+
+async def _follow_cluster_changes():
+    """Aplica cambios hechos por otros workers: configuración (sello en DB) y bitácora (último id)"""
+    config_stamp, last_log_id = await run_db(_cluster_stamps)
+    if config_stamp > cluster_state["config_seen"]:
+        cluster_state["config_seen"] = config_stamp
+        await rebuild_schedule(broadcast=False)
+        for kind in ("settings", "turns", "holidays", "automation"): mark_changed(kind)
+    if cluster_state["last_log_id"] is not None and last_log_id != cluster_state["last_log_id"]:
+        mark_changed("logs")
+    cluster_state["last_log_id"] = last_log_id
+
+async def cluster_coordinator():
+    """Elección de líder por arrendamiento en DB: solo el líder corre el motor y el Stop-Loss, así que
+    varios workers o contenedores no duplican escrituras en Meta"""
+    while True:
+        try:
+            is_leader = await run_db(try_acquire_lease, "engine", LEASE_TTL)
+        except Exception as e:
+            is_leader = False
+            logging.error(f"Error renovando liderazgo: {e}")
+        if is_leader and not cluster_state["leader"]:
+            logging.info(f"Worker {WORKER_ID} es líder del motor")
+            cluster_state["tasks"] = [asyncio.create_task(automation_engine()), asyncio.create_task(spend_tracker())]
+        elif not is_leader and cluster_state["leader"]:
+            # Sin arrendamiento vigente otro worker puede tomar el control: se detiene de inmediato
+            logging.info(f"Worker {WORKER_ID} deja de ser líder")
+            for task in cluster_state["tasks"]: task.cancel()
+            cluster_state["tasks"] = []
+        cluster_state["leader"] = is_leader
+        try:
+            await _follow_cluster_changes()
+        except Exception as e:
+            logging.error(f"Error siguiendo cambios de otros workers: {e}")
+        await asyncio.sleep(CLUSTER_POLL)
 
 # --- 2. CONSTANTES ---
 SHEET_ID = "1PGyE1TN5q1tEtoH5A-wxqS27DkONkNzp-hreL3OMJZw"
 API_VERSION = "v21.0"
+# Base de la Graph API; se puede apuntar a un servidor simulado (mock_graph.py) para pruebas de carga
+META_GRAPH_URL = os.environ.get("META_GRAPH_URL", "https://graph.facebook.com").rstrip("/")
 
 # Listado estricto permitido por negocio
 ALLOWED_IDS = [
@@ -86,7 +409,73 @@ ALLOWED_IDS = [
     "120232157515490717", "120232157515480717", "120232157515460717"
 ]
 
-meta_cache: Dict[str, Any] = {"data": None, "timestamp": 0}
+# Escrituras de estado hacia Meta (Batch API)
+META_BATCH_SIZE = 50        # Máximo de peticiones por llamada batch permitido por Graph
+META_WRITE_CONCURRENCY = 4  # Llamadas batch simultáneas
+META_WRITE_RETRIES = 3      # Intentos por elemento antes de darlo por fallido
+
+# Caché de AdSets de Meta (stale-while-revalidate con una sola descarga en vuelo)
+META_CACHE_TTL = 10         # Segundos que un snapshot se considera fresco
+META_IDS_PER_REQUEST = 50   # Máximo de IDs por consulta ?ids= de Graph
+# Grupos de campos que se descargan por separado: (campos, segundos entre refrescos)
+META_FIELD_GROUPS = {
+    "core": ("id,name,status,daily_budget,bid_amount,issues_info", META_CACHE_TTL),
+    "insights": ("insights.date_preset(today){spend,actions}", META_CACHE_TTL),
+    "ads": ("ads.limit(100){id,name,status}", 60),
+}
+
+meta_cache: Dict[str, Any] = {
+    "data": None, "timestamp": 0, "refresh": None, "core_refresh": None,
+    "parts": {g: {"data": {}, "timestamp": 0} for g in META_FIELD_GROUPS},
+    "stats": {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0, "errors": 0, "refresh_ms_last": 0.0, "refresh_ms_total": 0.0},
+}
+
+# Referencias fuertes a tareas en segundo plano para que no las recolecte el GC
+background_tasks = set()
+
+def run_in_background(coro):
+    """Lanza una corrutina sin bloquear la petición actual"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# Bitácora de cambios para /ads/sync incremental. La bitácora es local a cada proceso, así que
+# el cursor (y el ETag) lleva el WORKER_ID: con varios workers, un cursor de otro proceso (o de
+# uno anterior) nunca se confunde con uno propio y se responde el payload completo.
+SYNC_JOURNAL_SIZE = 2000
+sync_state: Dict[str, Any] = {"version": int(time.time() * 1000), "journal": deque(maxlen=SYNC_JOURNAL_SIZE), "changed": asyncio.Event()}
+sync_state["floor"] = sync_state["version"]
+
+def mark_changed(kind, key=None):
+    """Registra un cambio (meta, settings, turns, holidays, automation, logs). key=None significa 'todos'."""
+    journal = sync_state["journal"]
+    if len(journal) == journal.maxlen:
+        # Al expulsar la entrada más vieja, los cursores anteriores a ella ya no pueden recibir delta
+        sync_state["floor"] = journal[0][0]
+    sync_state["version"] += 1
+    journal.append((sync_state["version"], kind, key))
+    # Despierta a todos los suscriptores del canal push y deja un evento nuevo para la siguiente ronda
+    sync_state["changed"].set()
+    sync_state["changed"] = asyncio.Event()
+
+def sync_cursor():
+    """Cursor opaco '<WORKER_ID>:<versión>' que se entrega al cliente"""
+    return f"{WORKER_ID}:{sync_state['version']}"
+
+def changes_since(cursor):
+    """{tipo: set(claves)} cambiados después de `cursor`, o None si el cursor no es utilizable"""
+    worker, _, version = (cursor or "").rpartition(":")
+    if worker != WORKER_ID or not version.isdigit():
+        return None
+    version = int(version)
+    if version < sync_state["floor"] or version > sync_state["version"]:
+        return None
+    changed: Dict[str, set] = {}
+    for v, kind, key in reversed(sync_state["journal"]):
+        if v <= version: break
+        changed.setdefault(kind, set()).add(key)
+    return changed
 
 def get_google_creds():
     """Genera las credenciales para leer Google Sheets"""
@@ -107,16 +496,239 @@ def get_google_creds():
         logging.error(f"Creds Error: {e}")
         return None
 
+# Directorio de auditores: copia en memoria de la hoja Auditores, refrescada en segundo plano
+AUDITORS_TTL = 300          # Segundos entre lecturas de Google Sheets
+auditor_directory: Dict[str, Any] = {
+    "names": [], "hashes": {}, "loaded": False, "timestamp": 0, "service": None, "refresh": None,
+    # Llave de proceso: las contraseñas solo viven en memoria como HMAC, nunca en texto plano
+    "key": os.urandom(32),
+}
+
+def _hash_password(password):
+    return hmac.new(auditor_directory["key"], str(password).encode("utf-8"), hashlib.sha256).digest()
+
+def _fetch_auditor_rows():
+    """Lee la hoja Auditores (bloqueante: corre en un hilo). None si no hay credenciales."""
+    if auditor_directory["service"] is None:
+        creds = get_google_creds()
+        if not creds: return None
+        auditor_directory["service"] = build('sheets', 'v4', credentials=creds, cache_discovery=False)
+    res = auditor_directory["service"].spreadsheets().values().get(spreadsheetId=SHEET_ID, range="Auditores!A:B").execute()
+    return res.get('values', [])[1:]
+
+async def _refresh_auditors():
+    try:
+        rows = await asyncio.to_thread(_fetch_auditor_rows)
+        if rows is None: return
+        hashes: Dict[str, list] = {}
+        for row in rows:
+            if len(row) >= 2: hashes.setdefault(row[0], []).append(_hash_password(row[1]))
+        auditor_directory.update({
+            "names": [row[0] for row in rows if row], "hashes": hashes,
+            "loaded": True, "timestamp": time.time(),
+        })
+    except Exception as e:
+        # Si Sheets falla se conserva el último directorio válido
+        auditor_directory["service"] = None
+        logging.error(f"Error leyendo Auditores: {e}")
+    finally:
+        auditor_directory["refresh"] = None
+
+async def load_auditors():
+    """Lectura única en vuelo del directorio (varios llamadores comparten la misma)"""
+    if auditor_directory["refresh"] is None:
+        auditor_directory["refresh"] = asyncio.ensure_future(_refresh_auditors())
+    await asyncio.shield(auditor_directory["refresh"])
+
+async def auditor_refresher():
+    """Carga el directorio al arrancar y lo refresca cada AUDITORS_TTL"""
+    while True:
+        await load_auditors()
+        await asyncio.sleep(AUDITORS_TTL)
+
+# --- CLIENTE META CON CONTROL DE CUOTA ---
+META_MAX_RATE = 10.0        # Peticiones/segundo con cuota holgada
+META_MIN_RATE = 0.5         # Piso cuando la cuota está casi agotada
+META_BURST = 20             # Capacidad del token bucket
+META_READ_CUTOFF = 90       # % de uso a partir del cual solo salen escrituras y lecturas críticas
+META_USAGE_TTL = 60         # Segundos que vale la última lectura de uso sin nuevas respuestas
+META_MAX_RETRIES = 4
+META_BACKOFF_BASE = 1.0     # Segundos; se duplica por intento con jitter
+META_BACKOFF_MAX = 60.0
+META_THROTTLE_CODES = {4, 17, 32, 613, 80000, 80001, 80002, 80003, 80004, 80005, 80006, 80008, 80009, 80014}
+# Lecturas críticas (gasto para el Stop-Loss) no se detienen por el corte de lecturas, solo por throttling
+PRIORITY_WRITE, PRIORITY_CRITICAL, PRIORITY_READ = 0, 1, 2
+PRIORITY_NAMES = {PRIORITY_WRITE: "write", PRIORITY_CRITICAL: "critical", PRIORITY_READ: "read"}
+
+def _usage_from_headers(headers):
+    """(% de uso más alto, segundos de bloqueo) de X-App-Usage, X-Ad-Account-Usage y X-Business-Use-Case-Usage"""
+    pct, blocked = 0.0, 0.0
+    try:
+        for name in ("x-app-usage", "x-ad-account-usage"):
+            if headers.get(name):
+                data = json.loads(headers[name])
+                pct = max([pct] + [float(data[k]) for k in ("call_count", "total_cputime", "total_time", "acc_id_util_pct") if k in data])
+        if headers.get("x-business-use-case-usage"):
+            for entries in json.loads(headers["x-business-use-case-usage"]).values():
+                for e in entries:
+                    pct = max([pct] + [float(e[k]) for k in ("call_count", "total_cputime", "total_time") if k in e])
+                    blocked = max(blocked, float(e.get("estimated_time_to_regain_access", 0)) * 60)
+    except (ValueError, TypeError, AttributeError) as e:
+        logging.error(f"Header de uso de Meta ilegible: {e}")
+    return pct, blocked
+
+def _metric_endpoint(method, url):
+    """'GET .../v21.0/120238886501840717/ads' -> 'GET /{id}/ads': etiqueta de cardinalidad acotada"""
+    parts = [p for p in httpx.URL(str(url)).path.split("/") if p and p != API_VERSION]
+    return f"{method} /" + "/".join("{id}" if p.isdigit() or p.startswith("act_") else p for p in parts)
+
+class MetaClient:
+    """Cliente de Graph: token bucket ajustado por los headers de uso, escrituras antes que lecturas
+    y reintentos con backoff exponencial con jitter ante throttling (códigos 4/17/32/613/800xx) o fallas."""
+
+    def __init__(self):
+        self.http = httpx.AsyncClient(
+            timeout=httpx.Timeout(60.0, read=60.0), auth=MetaAuth(),
+            http2=importlib.util.find_spec("h2") is not None,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=120),
+        )
+        self.rate = META_MAX_RATE
+        self.tokens = float(META_BURST)
+        self.refilled = time.monotonic()
+        self.blocked_until = 0.0
+        self.usage_pct = 0.0
+        self.usage_at = 0.0
+        self.queue = []             # heap (prioridad, orden, future)
+        self.seq = itertools.count()
+        self.timer = None
+        self.timer_at = 0.0         # Instante (monotonic) en que dispara el timer agendado
+
+    async def get(self, url, priority=PRIORITY_READ, **kwargs):
+        return await self.request("GET", url, priority, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, PRIORITY_WRITE, **kwargs)
+
+    async def aclose(self):
+        await self.http.aclose()
+
+    def _reads_paused(self, now):
+        if now - self.usage_at > META_USAGE_TTL: self.usage_pct = 0.0
+        return self.usage_pct >= META_READ_CUTOFF
+
+    def reads_paused(self):
+        """¿Las lecturas normales están detenidas por cuota? El motor evalúa entonces sobre el snapshot en caché."""
+        return self._reads_paused(time.monotonic())
+
+    def _dispatch(self):
+        """Entrega turnos en orden de prioridad mientras haya tokens; si no, agenda el siguiente intento"""
+        now = time.monotonic()
+        self.tokens = min(META_BURST, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        reads_paused = False
+        while self.queue and now >= self.blocked_until and self.tokens >= 1:
+            priority, _, fut = self.queue[0]
+            if fut.cancelled():
+                heapq.heappop(self.queue); continue
+            # El heap ordena escrituras, lecturas críticas y lecturas; si la cabeza es lectura normal, no queda nada más urgente
+            if priority == PRIORITY_READ and self._reads_paused(now):
+                reads_paused = True; break
+            heapq.heappop(self.queue)
+            self.tokens -= 1
+            fut.set_result(None)
+        if not self.queue: return
+        delay = max(self.blocked_until - now, (1 - self.tokens) / self.rate, 0.05)
+        # La espera por cuota solo aplica si lo siguiente en la cola es una lectura normal
+        if reads_paused: delay = max(delay, self.usage_at + META_USAGE_TTL - now)
+        # Un timer largo (lectura detenida por cuota) se reemplaza si llega algo que debe salir antes
+        if self.timer is not None:
+            if self.timer_at <= now + delay: return
+            self.timer.cancel()
+        self.timer_at = now + delay
+        self.timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self):
+        self.timer = None
+        self._dispatch()
+
+    async def _acquire(self, priority):
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, (priority, next(self.seq), fut))
+        self._dispatch()
+        await fut
+
+    def _observe(self, res):
+        """Ajusta el ritmo según el uso reportado por Meta"""
+        pct, blocked = _usage_from_headers(res.headers)
+        now = time.monotonic()
+        if pct or blocked:
+            self.usage_pct, self.usage_at = pct, now
+        if blocked:
+            self.blocked_until = max(self.blocked_until, now + blocked)
+        # Lineal: cuota libre -> META_MAX_RATE, cuota agotada -> META_MIN_RATE
+        self.rate = max(META_MIN_RATE, META_MAX_RATE * (1 - self.usage_pct / 100))
+
+    @staticmethod
+    def _is_throttled(res):
+        if res.status_code == 429: return True
+        try:
+            err = res.json().get("error") if res.status_code >= 400 else None
+        except ValueError:
+            return False
+        return bool(err) and err.get("code") in META_THROTTLE_CODES
+
+    async def request(self, method, url, priority, **kwargs):
+        endpoint = _metric_endpoint(method, url)
+        for attempt in range(META_MAX_RETRIES + 1):
+            started = time.perf_counter()
+            await self._acquire(priority)
+            started = observe_since("metahandle_meta_queue_seconds", started, priority=PRIORITY_NAMES[priority])
+            try:
+                res = await self.http.request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                inc("metahandle_meta_errors_total", endpoint=endpoint, kind="transport")
+                if attempt == META_MAX_RETRIES: raise
+                logging.error(f"Error de red con Meta ({method} {url}): {e}")
+            else:
+                observe_since("metahandle_meta_request_seconds", started, endpoint=endpoint)
+                self._observe(res)
+                throttled = self._is_throttled(res)
+                if throttled or res.status_code >= 400:
+                    inc("metahandle_meta_errors_total", endpoint=endpoint, kind="throttled" if throttled else str(res.status_code))
+                if (not throttled and res.status_code < 500) or attempt == META_MAX_RETRIES:
+                    return res
+                logging.error(f"Meta {'throttling' if throttled else res.status_code} en {method} {url}, reintento {attempt + 1}")
+                if throttled:
+                    # Throttling pausa a todo el cliente; al reanudar, las escrituras en cola salen primero
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + min(META_BACKOFF_MAX, META_BACKOFF_BASE * 2 ** attempt))
+            await asyncio.sleep(min(META_BACKOFF_MAX, META_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5))
+
 app = FastAPI()
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"], expose_headers=["ETag"])
 
 # --- 3. EVENTOS DE INICIO Y MAPEO ESTRICTO ---
 @app.on_event("startup")
 async def startup_event():
-    """Inicializa la DB, mapea grupos por defecto y lanza el motor"""
-    app.state.client = httpx.AsyncClient(timeout=httpx.Timeout(60.0, read=60.0))
-    db = SessionLocal()
-    
+    """Inicializa la DB, mapea grupos por defecto y lanza la elección del líder del motor"""
+    app.state.client = MetaClient()
+    await run_db(seed_defaults)
+    await rebuild_schedule(broadcast=False)
+    asyncio.create_task(cluster_coordinator())
+    asyncio.create_task(auditor_refresher())
+    asyncio.create_task(log_flusher())
+    asyncio.create_task(loop_lag_monitor())
+
+def seed_defaults(db):
+    """Crea el estado del motor, los AdSets permitidos y los turnos por defecto (tolera a otro worker sembrando a la vez)"""
+    def attempt():
+        try:
+            _seed_defaults(db)
+        except DBAPIError:
+            db.rollback()
+            raise
+    run_db_setup(attempt)
+
+def _seed_defaults(db):
     if not db.query(AutomationState).first():
         db.add(AutomationState(id=1, is_active=False))
 
@@ -127,8 +739,9 @@ async def startup_event():
     g_nocturno = ["120238886501840717", "120238886472900717", "120238886420220717", "120238886413960717", "120232157515490717", "120232157515460717"]
 
     # Procesar la inicialización de AdSets permitidos
+    existing = {i for (i,) in db.query(AdSetSetting.id).filter(AdSetSetting.id.in_(ALLOWED_IDS))}
     for ad_id in ALLOWED_IDS:
-        if not db.query(AdSetSetting).filter_by(id=ad_id).first():
+        if ad_id not in existing:
             if ad_id in g_vespertino:
                 db.add(AdSetSetting(id=ad_id, turno="vespertino", limit_perc=85.0))
             elif ad_id in g_vesp_fsemana:
@@ -150,8 +763,9 @@ async def startup_event():
         "fsemana": {"start_hour": 7.0, "end_hour": 17.0, "days": "S"}
     }
     
+    turns = {t.name: t for t in db.query(TurnConfig).filter(TurnConfig.name.in_(list(default_turns)))}
     for k, v in default_turns.items():
-        t = db.query(TurnConfig).filter_by(name=k).first()
+        t = turns.get(k)
         if not t:
             db.add(TurnConfig(name=k, **v))
         else:
@@ -159,129 +773,689 @@ async def startup_event():
             t.end_hour = v["end_hour"]
             t.days = v["days"]
 
-    db.commit(); db.close()
-    asyncio.create_task(automation_engine())
+    db.commit()
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    await flush_logs()
+    if cluster_state["leader"]:
+        await run_db(release_lease, "engine")
     await app.state.client.aclose()
 
-async def get_meta_data_cached():
-    """Trae datos de Meta incluyendo Bid y Ads. Mantiene caché de 10s para rendimiento."""
-    curr_time = time.time()
-    if meta_cache["data"] and (curr_time - meta_cache["timestamp"] < 10):
-        return meta_cache["data"]
-    
-    # NUEVOS CAMPOS: bid_amount, issues_info, ads{id,name,status}
-    fields = "id,name,status,daily_budget,bid_amount,issues_info,insights.date_preset(today){spend,actions},ads{id,name,status}"
-    account_id = get_meta_ad_account_id()
-    url = f"https://graph.facebook.com/{API_VERSION}/{account_id}/adsets"
-    params = {"fields": fields, "access_token": get_meta_token(), "limit": "500"}
-    
-    try:
-        res = await app.state.client.get(url, params=params)
+async def fetch_all_pages(url, params=None, priority=PRIORITY_READ):
+    """Sigue los cursores paging.next de Graph hasta agotar el listado"""
+    rows = []
+    while url:
+        res = await app.state.client.get(url, priority, params=params)
         json_res = res.json()
         if "error" in json_res:
-            logging.error(f"Meta API Error in get_meta_data: {json_res['error']}")
-            return meta_cache["data"] or []
-            
-        data = json_res.get("data", [])
-        meta_cache["data"] = data
+            raise RuntimeError(f"Meta API Error paginando {url}: {json_res['error']}")
+        rows.extend(json_res.get("data", []))
+        # La URL `next` ya trae token y cursor
+        url, params = json_res.get("paging", {}).get("next"), None
+    return rows
+
+async def _fetch_field_group(group, priority=PRIORITY_READ):
+    """Descarga un grupo de campos solo para los AdSets gestionados, en bloques ?ids= concurrentes"""
+    fields, _ = META_FIELD_GROUPS[group]
+
+    async def fetch_chunk(ids):
+        res = await app.state.client.get(
+            f"{META_GRAPH_URL}/{API_VERSION}/", priority,
+            params={"ids": ",".join(ids), "fields": fields}
+        )
+        json_res = res.json()
+        if "error" in json_res:
+            raise RuntimeError(f"Meta API Error in get_meta_data ({group}): {json_res['error']}")
+        return json_res
+
+    chunks = [ALLOWED_IDS[i:i + META_IDS_PER_REQUEST] for i in range(0, len(ALLOWED_IDS), META_IDS_PER_REQUEST)]
+    found = {}
+    for chunk_res in await asyncio.gather(*(fetch_chunk(c) for c in chunks)):
+        found.update(chunk_res)
+
+    if group == "core":
+        return found
+    # Los edges anidados (ads) también paginan: se siguen los cursores de todos los AdSets a la vez
+    edges = {ad_id: obj.get(group, {"data": []}) for ad_id, obj in found.items()}
+    overflow = [ad_id for ad_id, edge in edges.items() if edge.get("paging", {}).get("next")]
+    pages = await asyncio.gather(*(fetch_all_pages(edges[ad_id]["paging"]["next"], priority=priority) for ad_id in overflow))
+    for ad_id, rows in zip(overflow, pages):
+        edges[ad_id] = {"data": edges[ad_id].get("data", []) + rows}
+    return {ad_id: {group: edge} for ad_id, edge in edges.items()}
+
+def _due_field_groups():
+    now = time.time()
+    return [g for g, (_, ttl) in META_FIELD_GROUPS.items() if now - meta_cache["parts"][g]["timestamp"] >= ttl]
+
+async def _load_shared_parts():
+    """Adopta los grupos que otro worker descargó más recientemente que nosotros"""
+    raw, _ = await run_db(read_snapshot, "meta_parts")
+    if not raw: return
+    parts = meta_cache["parts"]
+    for group, part in json.loads(raw).items():
+        if group in parts and part["timestamp"] > parts[group]["timestamp"]:
+            parts[group] = part
+
+async def _fetch_meta_adsets():
+    """Refresca los grupos de campos vencidos y arma el snapshot con la forma original de /adsets.
+    Entre workers solo uno descarga de Meta a la vez; los demás leen su resultado de la DB."""
+    parts = meta_cache["parts"]
+    await _load_shared_parts()
+    due = _due_field_groups()
+    if due:
+        if await run_db(try_acquire_lease, "meta_refresh", META_CACHE_TTL * 3):
+            try:
+                now = time.time()
+                results = await asyncio.gather(*(_fetch_field_group(g) for g in due), return_exceptions=True)
+                for group, result in zip(due, results):
+                    if isinstance(result, Exception):
+                        # Un grupo fallido conserva sus datos anteriores; sin datos base no hay snapshot
+                        if group == "core" and not parts["core"]["data"]: raise result
+                        logging.error(f"Error refrescando {group} de Meta: {result}")
+                        continue
+                    # Una lectura crítica de campos base pudo terminar mientras tanto con datos más nuevos
+                    if now >= parts[group]["timestamp"]:
+                        parts[group] = {"data": result, "timestamp": now}
+                await run_db(write_snapshot, "meta_parts", json.dumps(parts))
+            finally:
+                await run_db(release_lease, "meta_refresh")
+        elif not parts["core"]["data"]:
+            # Otro worker está descargando el primer snapshot: se espera a que lo publique
+            for _ in range(META_CACHE_TTL * 3):
+                await asyncio.sleep(1)
+                await _load_shared_parts()
+                if parts["core"]["data"]: break
+    return _assemble_snapshot()
+
+def _assemble_snapshot():
+    """Une los grupos de campos en la forma original de /adsets"""
+    parts = meta_cache["parts"]
+    data = []
+    for ad_id in ALLOWED_IDS:
+        core = parts["core"]["data"].get(ad_id)
+        if not core: continue
+        ad = dict(core)
+        for group in ("insights", "ads"):
+            ad.update(parts[group]["data"].get(ad_id, {}))
+        data.append(ad)
+    return data
+
+async def _refresh_meta_cache():
+    """Única descarga en vuelo; si falla conserva el snapshot anterior"""
+    stats = meta_cache["stats"]
+    stats["refreshes"] += 1
+    curr_time = time.time()
+    started = time.perf_counter()
+    try:
+        _publish_snapshot(await _fetch_meta_adsets())
         meta_cache["timestamp"] = curr_time
-        return data
-    except Exception as e: 
+    except Exception as e:
+        stats["errors"] += 1
         logging.error(f"Error caché Meta: {e}")
-        return meta_cache["data"] or []
+    finally:
+        elapsed = (time.perf_counter() - started) * 1000
+        stats["refresh_ms_last"] = elapsed
+        stats["refresh_ms_total"] += elapsed
+        meta_cache["refresh"] = None
+    return meta_cache["data"] or []
 
-# --- 4. MOTOR DE AUTOMATIZACIÓN AVANZADO ---
-async def automation_engine():
-    """Valida reglas, doble reseteo y Días Festivos (Blackout)"""
-    while True:
-        await asyncio.sleep(45)
-        db = SessionLocal()
+def _publish_snapshot(data):
+    """Reemplaza el snapshot y marca en la bitácora solo los AdSets que cambiaron"""
+    previous = {ad["id"]: ad for ad in meta_cache["data"] or []}
+    for ad in data:
+        if previous.pop(ad["id"], None) != ad: mark_changed("meta", ad["id"])
+    for ad_id in previous: mark_changed("meta", ad_id)
+    meta_cache["data"] = data
+
+async def _refresh_core_fields():
+    try:
+        now = time.time()
+        core = await _fetch_field_group("core", PRIORITY_CRITICAL)
+        if now >= meta_cache["parts"]["core"]["timestamp"]:
+            meta_cache["parts"]["core"] = {"data": core, "timestamp": now}
+            _publish_snapshot(_assemble_snapshot())
+    except Exception as e:
+        logging.error(f"Error refrescando campos base de Meta: {e}")
+    finally:
+        meta_cache["core_refresh"] = None
+
+def start_core_refresh():
+    """Relectura de solo los campos base a prioridad crítica, con su propio single-flight: no se sube a una
+    descarga completa en curso (prioridad normal, detenida por cuota) ni espera el lease entre workers"""
+    if meta_cache["core_refresh"] is None:
+        meta_cache["core_refresh"] = run_in_background(_refresh_core_fields())
+    return meta_cache["core_refresh"]
+
+def _start_meta_refresh():
+    """Regresa la descarga en curso o inicia una nueva (single-flight)"""
+    if meta_cache["refresh"] is None:
+        meta_cache["refresh"] = run_in_background(_refresh_meta_cache())
+    return meta_cache["refresh"]
+
+async def get_meta_data_cached(max_age=None):
+    """Trae datos de Meta incluyendo Bid y Ads. Fresco por META_CACHE_TTL; después sirve el snapshot viejo
+    mientras se refresca en segundo plano. Con `max_age` espera la descarga si el snapshot es más viejo."""
+    stats = meta_cache["stats"]
+    age = time.time() - meta_cache["timestamp"]
+    if meta_cache["data"] is not None:
+        if age < META_CACHE_TTL:
+            stats["hits"] += 1
+            return meta_cache["data"]
+        if max_age is None or age < max_age:
+            stats["stale_hits"] += 1
+            _start_meta_refresh()
+            return meta_cache["data"]
+    stats["misses"] += 1
+    # shield: si el cliente que espera se cancela, la descarga compartida continúa
+    return await asyncio.shield(_start_meta_refresh())
+
+def patch_cached_adset(adset_id, fields):
+    """Aplica cambios ya confirmados por Meta sobre el AdSet en caché"""
+    parts = meta_cache["parts"]
+    for key, value in fields.items():
+        group = key if key in ("insights", "ads") else "core"
+        if group == "core" and adset_id not in parts["core"]["data"]: continue
+        parts[group]["data"].setdefault(adset_id, {})[key] = value
+    for ad in meta_cache["data"] or []:
+        if ad.get("id") == adset_id:
+            ad.update(fields)
+            mark_changed("meta", adset_id)
+            return
+
+async def refresh_adset(adset_id):
+    """Vuelve a leer los campos base (estado, presupuesto, puja) de un AdSet y los reemplaza en el caché.
+    Los edges paginados (ads) e insights quedan a cargo de sus propios refrescos por grupo."""
+    try:
+        res = await app.state.client.get(
+            f"{META_GRAPH_URL}/{API_VERSION}/{adset_id}",
+            params={"fields": META_FIELD_GROUPS["core"][0]}
+        )
+        json_res = res.json()
+        if "error" in json_res:
+            logging.error(f"Meta API Error refrescando AdSet {adset_id}: {json_res['error']}")
+            return
+        patch_cached_adset(adset_id, json_res)
+    except Exception as e:
+        logging.error(f"Error refrescando AdSet {adset_id}: {e}")
+
+def invalidate_adset(adset_id, **fields):
+    """Refleja de inmediato una escritura y refresca solo ese AdSet en segundo plano"""
+    if fields: patch_cached_adset(adset_id, fields)
+    run_in_background(refresh_adset(adset_id))
+
+async def _post_status_batch(chunk):
+    """Envía un bloque de cambios de estado como una sola llamada Batch de Graph"""
+    batch = [{"method": "POST", "relative_url": f"{API_VERSION}/{ad_id}", "body": f"status={status}"} for ad_id, status in chunk]
+    res = await app.state.client.post(f"{META_GRAPH_URL}/", data={"batch": json.dumps(batch), "include_headers": "false"})
+    replies = res.json()
+    if not isinstance(replies, list):
+        logging.error(f"Meta Batch Error: {replies.get('error') if isinstance(replies, dict) else replies}")
+        return {ad_id: False for ad_id, _ in chunk}
+    # Cada respuesta corresponde por posición; null significa que Meta no la procesó
+    return {ad_id: bool(r) and r.get("code") == 200 for (ad_id, _), r in zip(chunk, replies)}
+
+async def apply_status_transitions(transitions):
+    """Aplica [(adset_id, status)] en bloques batch concurrentes con reintento por elemento"""
+    results = {}
+    pending = list(transitions)
+    sem = asyncio.Semaphore(META_WRITE_CONCURRENCY)
+
+    async def run(chunk):
+        async with sem:
+            try:
+                return await _post_status_batch(chunk)
+            except Exception as e:
+                logging.error(f"Error enviando batch de estados: {e}")
+                return {ad_id: False for ad_id, _ in chunk}
+
+    for attempt in range(META_WRITE_RETRIES):
+        chunks = [pending[i:i + META_BATCH_SIZE] for i in range(0, len(pending), META_BATCH_SIZE)]
+        for r in await asyncio.gather(*(run(c) for c in chunks)):
+            results.update(r)
+        # Solo se reintentan los elementos que fallaron
+        pending = [t for t in pending if not results.get(t[0])]
+        if not pending: break
+        await asyncio.sleep(2 ** attempt)
+
+    for ad_id, status in pending:
+        logging.error(f"No se pudo cambiar {ad_id} a {status} tras {META_WRITE_RETRIES} intentos")
+    return results
+
+# --- 4. MODELO DE HORARIOS COMPILADO ---
+MEX_TZ = pytz.timezone('America/Mexico_City')
+DAY_MAP = {'L': 0, 'M': 1, 'X': 2, 'J': 3, 'V': 4, 'S': 5, 'D': 6}
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+RESET_HOURS = [0, 4]        # DOBLE RESETEO (Freeze): 00:00 y 04:00 AM
+
+# Despierta al motor cuando cambia la configuración (turnos, festivos, ajustes, encendido)
+engine_wakeup = asyncio.Event()
+
+# Índice en memoria: se reconstruye solo cuando cambian turnos, festivos o ajustes
+schedule: Dict[str, Any] = {
+    "adsets": {}, "holidays": set(), "automation_active": False,
+    "boundaries": {}, "boundary_minutes": [],
+}
+
+def parse_turn_days(days):
+    """Convierte 'L,M,X' en el conjunto de días (0 = Lunes). Acepta 'L-V' y cae a todos los días si está malformado."""
+    days_cfg = (days or "").upper().strip()
+    target_days = {DAY_MAP[d.strip()] for d in days_cfg.split(',') if d.strip() in DAY_MAP}
+    if target_days: return target_days
+    if days_cfg == "L-V": return {0, 1, 2, 3, 4}
+    return set(range(7))
+
+def compile_turn_mask(turn):
+    """Tabla semanal minuto a minuto (1 = dentro del turno) para un TurnConfig"""
+    mask = bytearray(MINUTES_PER_WEEK)
+    day_minutes = bytes(1 if turn.start_hour <= m / 60 < turn.end_hour else 0 for m in range(MINUTES_PER_DAY))
+    for d in parse_turn_days(turn.days):
+        mask[d * MINUTES_PER_DAY:(d + 1) * MINUTES_PER_DAY] = day_minutes
+    return mask
+
+def compile_boundaries(adsets):
+    """Minutos de la semana donde algún AdSet entra o sale de turno, más los reseteos diarios"""
+    boundaries = {d * MINUTES_PER_DAY + h * 60: {"reset"} for d in range(7) for h in RESET_HOURS}
+    for mask in {s["mask"] for s in adsets}:
+        # XOR contra la máscara desplazada un minuto (circular): queda 1 justo donde cambia el estado
+        diff = int.from_bytes(mask, "big") ^ int.from_bytes(mask[-1:] + mask[:-1], "big")
+        for m in re.finditer(rb"\x01", diff.to_bytes(MINUTES_PER_WEEK, "big")):
+            boundaries.setdefault(m.start(), set()).add("turn")
+    return boundaries
+
+def compile_schedule(turns, settings, holidays, automation_active):
+    """Compila turnos, asignaciones y festivos en el índice que consulta el motor (sin tocar la DB)"""
+    # Máscaras como enteros: el OR de bytes 0/1 se hace en una sola operación
+    turn_bits = {t.name.lower(): int.from_bytes(compile_turn_mask(t), "big") for t in turns}
+    masks = {}  # Una máscara por combinación distinta de turnos; los AdSets del mismo turno la comparten
+    adsets = {}
+    for s in settings:
+        names = frozenset(t.strip().lower() for t in (s.turno or "").split(",") if t.strip())
+        if names not in masks:
+            bits = 0
+            for t_name in names: bits |= turn_bits.get(t_name, 0)
+            masks[names] = bits.to_bytes(MINUTES_PER_WEEK, "big")
+        adsets[s.id] = {"mask": masks[names], "limit_perc": s.limit_perc or 0.0, "is_frozen": bool(s.is_frozen)}
+    boundaries = compile_boundaries(adsets.values())
+    return {
+        "adsets": adsets, "holidays": set(holidays), "automation_active": automation_active,
+        "boundaries": boundaries, "boundary_minutes": sorted(boundaries),
+    }
+
+def _load_schedule(db):
+    """Lee y compila turnos, asignaciones y festivos (corre en el pool de DB)"""
+    state = db.query(AutomationState).first()
+    return compile_schedule(
+        db.query(TurnConfig).all(), db.query(AdSetSetting).all(),
+        {h.date for h in db.query(HolidayConfig).all()}, bool(state and state.is_active),
+    )
+
+async def rebuild_schedule(broadcast=True):
+    """Recompila el índice en memoria desde la DB y despierta al motor. Con broadcast avisa a los demás workers."""
+    schedule.update(await run_db(_load_schedule))
+    if broadcast:
+        cluster_state["config_seen"] = await run_db(write_snapshot, "config")
+    engine_wakeup.set()
+
+def is_adset_in_time(adset_id, now):
+    """O(1): ¿el AdSet está dentro de alguno de sus turnos en el instante `now` (hora CDMX)?"""
+    s = schedule["adsets"].get(adset_id)
+    if not s: return False
+    # Regla: Si es festivo, la automatización asume que NO es tiempo de encender.
+    if now.strftime('%Y-%m-%d') in schedule["holidays"]: return False
+    return s["mask"][now.weekday() * MINUTES_PER_DAY + now.hour * 60 + now.minute] == 1
+
+# --- SIMULACIÓN DE HORARIOS (vista previa sin tocar Meta) ---
+SIMULATION_MAX_DAYS = 92
+
+def _is_iso_date(value):
+    """¿`value` es una fecha YYYY-MM-DD tal como se guardan los festivos?"""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d') == value
+    except (TypeError, ValueError):
+        return False
+
+def _simulation_schedule(db, req):
+    """Compila la configuración guardada con los cambios propuestos de `req` encima, sin guardarlos.
+    turns: {nombre: {start, end, days} | null}, settings: {adset_id: {turno, is_frozen}}, holidays: [fechas]"""
+    turns = {t.name.lower(): t for t in db.query(TurnConfig).all()}
+    for name, cfg in (req.get("turns") or {}).items():
+        base = turns.pop(name.lower(), None)
+        if cfg is None: continue
+        turns[name.lower()] = TurnConfig(
+            name=name, days=cfg.get("days", getattr(base, "days", "L,M,X,J,V")),
+            start_hour=float(cfg["start"]) if "start" in cfg else base.start_hour,
+            end_hour=float(cfg["end"]) if "end" in cfg else base.end_hour,
+        )
+    settings = {s.id: s for s in db.query(AdSetSetting).all()}
+    for ad_id, cfg in (req.get("settings") or {}).items():
+        base = settings.get(ad_id)
+        settings[ad_id] = AdSetSetting(
+            id=ad_id, turno=cfg.get("turno", getattr(base, "turno", "")),
+            limit_perc=getattr(base, "limit_perc", 0.0), is_frozen=bool(cfg.get("is_frozen", getattr(base, "is_frozen", False))),
+        )
+    holidays = req.get("holidays")
+    if holidays is None:
+        holidays = [h.date for h in db.query(HolidayConfig).all()]
+    elif not isinstance(holidays, list) or not all(_is_iso_date(h) for h in holidays):
+        raise ValueError("holidays debe ser una lista de fechas YYYY-MM-DD")
+    state = db.query(AutomationState).first()
+    return compile_schedule(turns.values(), settings.values(), holidays, bool(state and state.is_active))
+
+def simulate_timeline(compiled, start, end, ids, now):
+    """Encendido/apagado minuto a minuto (hora CDMX) de cada AdSet entre `start` y `end` inclusive, con las
+    reglas del motor: máscara semanal de turnos y festivo = día apagado. Un AdSet congelado queda fuera de
+    control desde `now` hasta el siguiente reseteo: el motor no lo toca, así que ese tramo se reporta en
+    `frozen` como desconocido (no cuenta como encendido ni como apagado; sus minutos van en `minutes_unknown`).
+    El Stop-Loss depende del gasto real y no se simula."""
+    days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    origin = datetime(start.year, start.month, start.day)
+    total = len(days) * MINUTES_PER_DAY
+    off_day = bytes(MINUTES_PER_DAY)
+    at = lambda m: MEX_TZ.localize(origin + timedelta(minutes=m)).isoformat()
+
+    # Un buffer por máscara distinta: los AdSets del mismo turno comparten la misma línea de tiempo
+    timelines = {}
+    def timeline(mask):
+        if mask not in timelines:
+            timelines[mask] = b"".join(
+                off_day if d.isoformat() in compiled["holidays"]
+                else mask[d.weekday() * MINUTES_PER_DAY:(d.weekday() + 1) * MINUTES_PER_DAY]
+                for d in days
+            )
+        return timelines[mask]
+
+    now_m = int((now.replace(tzinfo=None) - origin).total_seconds() // 60)
+    result, rendered = {}, {}
+    for ad_id in ids:
+        s = compiled["adsets"].get(ad_id)
+        if not s:
+            result[ad_id] = {"managed": False, "on": [], "minutes_on": 0, "minutes_unknown": total, "frozen": None}
+            continue
+        frozen = None
+        if s["is_frozen"] and 0 <= now_m < total:
+            day_m = now_m - now_m % MINUTES_PER_DAY
+            resets = [day_m + h * 60 for h in RESET_HOURS] + [day_m + MINUTES_PER_DAY + RESET_HOURS[0] * 60]
+            frozen = (now_m, min(min(r for r in resets if r > now_m), total))
+        key = (s["mask"], frozen)
+        if key not in rendered:
+            minutes = timeline(s["mask"])
+            # El tramo congelado se marca con 0x02: corta los tramos encendidos sin contarse como apagado
+            if frozen: minutes = minutes[:frozen[0]] + b"\x02" * (frozen[1] - frozen[0]) + minutes[frozen[1]:]
+            runs = [m.span() for m in re.finditer(rb"\x01+", minutes)]
+            rendered[key] = {
+                "managed": True,
+                "on": [[at(a), at(b)] for a, b in runs],
+                "minutes_on": sum(b - a for a, b in runs),
+                "minutes_unknown": frozen[1] - frozen[0] if frozen else 0,
+                "frozen": [at(frozen[0]), at(frozen[1])] if frozen else None,
+            }
+        result[ad_id] = rendered[key]
+    return result
+
+# --- 5. MOTOR DE AUTOMATIZACIÓN AVANZADO ---
+ENGINE_RETRY_DELAY = 30         # Segundos antes de reevaluar cuando Meta rechazó alguna transición
+ENGINE_RECONCILE_INTERVAL = 300 # Segundos entre pasadas de conciliación (cambios manuales o hechos en Ads Manager)
+
+# cursor: última frontera ya procesada; retry_at: instante (monotonic) de la siguiente reevaluación por fallas
+engine_state: Dict[str, Any] = {"cursor": None, "retry_at": None}
+
+def _unfreeze_all(db):
+    db.query(AdSetSetting).update({"is_frozen": False})
+    db.commit()
+
+async def reset_frozen_adsets():
+    """Descongela todos los AdSets (reseteo programado)"""
+    await run_db(_unfreeze_all)
+    mark_changed("settings")
+    await rebuild_schedule()
+
+def next_engine_event(now):
+    """Siguiente frontera exacta (inicio/fin de turno o reseteo) posterior a `now`. Regresa (instante, tipos)."""
+    boundaries = schedule["boundaries"]
+    minutes = schedule["boundary_minutes"]
+    curr_m = now.weekday() * MINUTES_PER_DAY + now.hour * 60 + now.minute
+    idx = bisect.bisect_right(minutes, curr_m)
+    target_m = minutes[idx] if idx < len(minutes) else minutes[0] + MINUTES_PER_WEEK
+    week_start = now.replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0) - timedelta(days=now.weekday())
+    at = MEX_TZ.localize(week_start + timedelta(minutes=target_m))
+    return at, boundaries[target_m % MINUTES_PER_WEEK]
+
+async def evaluate_adsets(now, max_age=META_CACHE_TTL):
+    """Aplica reglas de horario y Stop-Loss a todos los AdSets gestionados. Con max_age=None evalúa sobre el
+    snapshot en caché (conciliación). Regresa False si algo quedó pendiente: transiciones rechazadas o sin snapshot."""
+    # Si la automatización está apagada, no procesamos adsets
+    if not schedule["automation_active"]: 
+        return True
+
+    tick_started = started = time.perf_counter()
+    # Con la cuota al límite las lecturas esperan hasta META_USAGE_TTL: las fronteras no se detienen por eso,
+    # se evalúa sobre el snapshot (que refleja nuestras propias escrituras) y se reevalúa al reintentar
+    from_snapshot = max_age is not None and meta_cache["data"] is not None and app.state.client.reads_paused()
+    meta_data = await get_meta_data_cached(max_age=None if from_snapshot else max_age)
+    if meta_cache["data"] is None: return False
+    started = observe_since("metahandle_engine_tick_seconds", started, loop="schedule", stage="meta_fetch")
+    
+    transitions, reasons = [], {}
+    is_holiday = now.strftime('%Y-%m-%d') in schedule["holidays"]
+    for ad in meta_data:
         try:
-            state = db.query(AutomationState).first()
-            if not state: continue
+            s = schedule["adsets"].get(ad['id'])
+            if not s or s["is_frozen"]: continue
+            
+            # Turnos y BLACKOUT DATES (Días festivos) desde el índice compilado
+            in_time = is_adset_in_time(ad['id'], now)
+
+            # Control de Presupuesto (Stop-Loss): misma regla que el tracker de gasto, incluida la proyección
+            over, over_reason, _, _ = stop_loss_check(ad, s)
             
-            mex_tz = pytz.timezone('America/Mexico_City')
-            now = datetime.now(mex_tz)
+            should_be_active = in_time and not over
             
-            # 1. DOBLE RESETEO (Freeze): 00:00 y 04:00 AM
-            if now.hour in [0, 4] and now.minute < 2:
-                db.query(AdSetSetting).update({"is_frozen": False})
-                db.commit()
+            if should_be_active and ad['status'] != 'ACTIVE':
+                transitions.append((ad['id'], "ACTIVE"))
+                reasons[ad['id']] = "en horario"
+            elif not should_be_active and ad['status'] == 'ACTIVE':
+                transitions.append((ad['id'], "PAUSED"))
+                if over: reasons[ad['id']] = over_reason
+                else: reasons[ad['id']] = "día festivo" if is_holiday else "fuera de horario"
+        except Exception as ad_err:
+            logging.error(f"Error procesando AdSet {ad.get('id')}: {ad_err}")
+    started = observe_since("metahandle_engine_tick_seconds", started, loop="schedule", stage="rules")
+    observe("metahandle_engine_transitions", len(transitions), buckets=METRICS_COUNT_BUCKETS, loop="schedule")
 
-            # 2. BLACKOUT DATES (Días festivos)
-            today_str = now.strftime('%Y-%m-%d')
-            is_holiday = db.query(HolidayConfig).filter(HolidayConfig.date == today_str).first() is not None
+    failed = await apply_engine_transitions(transitions, reasons)
+    observe_since("metahandle_engine_tick_seconds", started, loop="schedule", stage="writes")
+    observe_since("metahandle_engine_tick_seconds", tick_started, loop="schedule", stage="total")
+    return not failed and not from_snapshot
 
-            # Si la automatización está apagada, no procesamos adsets
-            if not state.is_active: 
-                continue
+async def apply_engine_transitions(transitions, reasons):
+    """Todas las transiciones del ciclo salen juntas en llamadas batch, se reflejan en el caché y quedan en bitácora.
+    Regresa los IDs que Meta no aceptó."""
+    if not transitions: return []
+    results = await apply_status_transitions(transitions)
+    failed = []
+    for ad_id, status in transitions:
+        inc("metahandle_engine_transitions_total", status=status, result="ok" if results.get(ad_id) else "failed")
+        if not results.get(ad_id):
+            failed.append(ad_id)
+            continue
+        patch_cached_adset(ad_id, {"status": status})
+        log_action("Motor", f"Auto: {status} en {ad_id} ({reasons[ad_id]})", adset_id=ad_id, reason=reasons[ad_id])
+    return failed
 
-            curr_h = now.hour + (now.minute / 60)
-            day_of_week = now.weekday() 
-            
-            turns = {t.name.lower(): t for t in db.query(TurnConfig).all()}
-            meta_data = await get_meta_data_cached()
-            
-            for ad in meta_data:
-                try:
-                    s = db.query(AdSetSetting).filter(AdSetSetting.id == ad['id']).first()
-                    if not s or s.is_frozen: continue
-                    
-                    # Regla: Si es festivo, la automatización asume que NO es tiempo de encender.
-                    in_time = False 
-
-                    if not is_holiday:
-                        assigned = [t.strip().lower() for t in s.turno.split(",") if t.strip()]
-                        for t_name in assigned:
-                            turn = turns.get(t_name)
-                            if not turn: continue
-                            
-                            # Validar hora
-                            time_match = turn.start_hour <= curr_h < turn.end_hour
-                            
-                            # Validar día específico
-                            day_match = False
-                            days_cfg = turn.days.upper().strip()
-                            day_map = {'L': 0, 'M': 1, 'X': 2, 'J': 3, 'V': 4, 'S': 5, 'D': 6}
-                            target_days = [day_map.get(d.strip()) for d in days_cfg.split(',') if d.strip() in day_map]
-                            
-                            if target_days:
-                                day_match = day_of_week in target_days
-                            elif days_cfg == "L-V":
-                                day_match = 0 <= day_of_week <= 4
-                            else:
-                                day_match = True # Fallback por si hay malformación
-                            
-                            if time_match and day_match:
-                                in_time = True
-                                break
-
-                    # Control de Presupuesto (Stop-Loss)
-                    insights_data = ad.get("insights", {}).get("data", []) if ad.get("insights") else []
-                    spend = float(insights_data[0].get("spend", 0)) if insights_data and len(insights_data) > 0 else 0.0
-                    
-                    daily_budget_raw = ad.get("daily_budget")
-                    budget = float(daily_budget_raw) / 100 if daily_budget_raw else 0.0
-                    
-                    over = (spend / budget * 100) >= s.limit_perc if budget > 0 else False
-                    
-                    should_be_active = in_time and not over
-                    token = get_meta_token()
-                    
-                    if should_be_active and ad['status'] != 'ACTIVE':
-                        await app.state.client.post(f"https://graph.facebook.com/{API_VERSION}/{ad['id']}", params={"status": "ACTIVE", "access_token": token})
-                    elif not should_be_active and ad['status'] == 'ACTIVE':
-                        await app.state.client.post(f"https://graph.facebook.com/{API_VERSION}/{ad['id']}", params={"status": "PAUSED", "access_token": token})
-                except Exception as ad_err:
-                    logging.error(f"Error procesando AdSet {ad.get('id')}: {ad_err}")
+def passed_boundaries(cursor, now):
+    """Fronteras en (cursor, now]: regresa (última frontera alcanzada, tipos acumulados). Una evaluación lenta
+    que cruza una o varias fronteras no las pierde: se procesan todas juntas al terminar."""
+    kinds = set()
+    at, at_kinds = next_engine_event(cursor)
+    while at <= now:
+        kinds |= at_kinds
+        cursor = at
+        at, at_kinds = next_engine_event(at)
+    return cursor, kinds
+
+async def automation_engine():
+    """Despierta en cada frontera de turno y reseteo (recuperando las que se hayan cruzado), cuando cambia la
+    configuración, para reintentar transiciones que Meta rechazó y en una conciliación periódica con el caché"""
+    engine_state["cursor"] = datetime.now(MEX_TZ)
+    next_reconcile = time.monotonic() + ENGINE_RECONCILE_INTERVAL
+    while True:
+        now = datetime.now(MEX_TZ)
+        at, _ = next_engine_event(engine_state["cursor"])
+        timeout = min((at - now).total_seconds(), next_reconcile - time.monotonic())
+        if engine_state["retry_at"] is not None:
+            timeout = min(timeout, engine_state["retry_at"] - time.monotonic())
+        try:
+            await asyncio.wait_for(engine_wakeup.wait(), max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
+        changed = engine_wakeup.is_set()
+        engine_wakeup.clear()
+
+        try:
+            now = datetime.now(MEX_TZ)
+            cursor, kinds = passed_boundaries(engine_state["cursor"], now)
+            retry_due = engine_state["retry_at"] is not None and time.monotonic() >= engine_state["retry_at"]
+            reconcile_due = time.monotonic() >= next_reconcile
+            if not (kinds or changed or retry_due or reconcile_due): continue
+
+            if "reset" in kinds:
+                started = time.perf_counter()
+                await reset_frozen_adsets()
+                observe_since("metahandle_engine_tick_seconds", started, loop="schedule", stage="db")
+                engine_wakeup.clear()
+            # La conciliación sola no fuerza una descarga: usa el snapshot y lo refresca en segundo plano
+            complete = await evaluate_adsets(now, max_age=META_CACHE_TTL if kinds or changed or retry_due else None)
+            engine_state["cursor"] = cursor
+            engine_state["retry_at"] = None if complete else time.monotonic() + ENGINE_RETRY_DELAY
+            next_reconcile = time.monotonic() + ENGINE_RECONCILE_INTERVAL
         except Exception as e:
+            # El cursor no avanza: las fronteras pendientes se vuelven a procesar en el reintento
+            engine_state["retry_at"] = time.monotonic() + ENGINE_RETRY_DELAY
             logging.error(f"Automation Engine Error: {e}")
-        finally: db.close()
 
-# --- 5. ENDPOINTS DE LA API ---
+# --- STOP-LOSS INCREMENTAL (serie local de gasto) ---
+SPEND_POLL_MIN = 15         # Segundos entre lecturas cuando algún AdSet está cerca de su límite
+SPEND_POLL_MAX = 120        # Segundos entre lecturas cuando todos están lejos
+SPEND_HISTORY = 40          # Muestras por AdSet en el ring buffer
+SPEND_RATE_WINDOW = 900     # Segundos de historia usados para proyectar el ritmo de gasto
+SPEND_HEADROOM_SLOW = 0.25  # Fracción del límite restante por debajo de la cual el intervalo se acorta en proporción
+
+# adset_id -> deque[(timestamp, gasto acumulado de hoy)]
+spend_history: Dict[str, deque] = defaultdict(lambda: deque(maxlen=SPEND_HISTORY))
+# adset_id -> (limit_perc, día) de una pausa por proyección: se sostiene hasta que el gasto se reinicia
+# o cambia el límite, para que una reevaluación no la revierta cuando el ritmo medido baja tras pausar
+spend_projected: Dict[str, tuple] = {}
+
+def adset_budget(ad):
+    """Presupuesto diario en unidades de moneda (Meta lo reporta en centavos)"""
+    daily_budget_raw = ad.get("daily_budget")
+    return float(daily_budget_raw) / 100 if daily_budget_raw else 0.0
+
+def current_spend(ad):
+    """Gasto de hoy: la muestra más reciente del tracker si es más nueva que el snapshot de insights"""
+    history = spend_history.get(ad['id'])
+    if history and history[-1][0] >= meta_cache["parts"]["insights"]["timestamp"]:
+        return history[-1][1]
+    insights_data = ad.get("insights", {}).get("data", []) if ad.get("insights") else []
+    return float(insights_data[0].get("spend", 0)) if insights_data else 0.0
+
+def spend_rate(adset_id):
+    """Ritmo de gasto ($/s) entre la muestra más vieja dentro de la ventana y la más reciente"""
+    history = spend_history.get(adset_id)
+    if not history or len(history) < 2: return 0.0
+    t1, s1 = history[-1]
+    t0, s0 = next(((t, sp) for t, sp in history if t1 - t <= SPEND_RATE_WINDOW), history[-1])
+    return (s1 - s0) / (t1 - t0) if t1 > t0 else 0.0
+
+async def _poll_adset_spend():
+    """Solo gasto de hoy por AdSet, a nivel cuenta: sin campos base ni el edge ads{}"""
+    account_id = get_meta_ad_account_id()
+    rows = await fetch_all_pages(f"{META_GRAPH_URL}/{API_VERSION}/{account_id}/insights", {
+        "level": "adset", "date_preset": "today", "fields": "adset_id,spend", "limit": "500",
+        "filtering": json.dumps([{"field": "adset.id", "operator": "IN", "value": ALLOWED_IDS}]),
+    }, priority=PRIORITY_CRITICAL)
+    now = time.time()
+    for row in rows:
+        history = spend_history[row["adset_id"]]
+        spend = float(row.get("spend", 0))
+        # Cambio de día: el acumulado vuelve a empezar
+        if history and spend < history[-1][1]:
+            history.clear()
+            spend_projected.pop(row["adset_id"], None)
+        history.append((now, spend))
+
+def stop_loss_check(ad, s):
+    """Regla única de Stop-Loss para el motor y el tracker. Regresa (pausar, motivo, segundos hasta el límite,
+    fracción del límite que queda). Pausa si el gasto ya alcanzó el límite, si al ritmo actual lo cruza antes
+    de la siguiente lectura, o si sigue vigente una pausa por proyección de hoy con el mismo límite."""
+    budget = adset_budget(ad)
+    if budget <= 0: return False, None, float("inf"), 1.0
+    limit = budget * s["limit_perc"] / 100
+    spend = current_spend(ad)
+    remaining = limit - spend
+    if remaining <= 0:
+        return True, f"sobre presupuesto ({spend / budget * 100:.1f}% >= {s['limit_perc']:g}%)", 0.0, 0.0
+    headroom = remaining / limit
+    today = datetime.now(MEX_TZ).strftime('%Y-%m-%d')
+    if spend_projected.get(ad['id']) == (s["limit_perc"], today):
+        return True, f"proyección vigente ({spend / budget * 100:.1f}% de {s['limit_perc']:g}%)", 0.0, headroom
+    spend_projected.pop(ad['id'], None)
+    rate = spend_rate(ad['id'])
+    time_to_limit = remaining / rate if rate > 0 else float("inf")
+    if time_to_limit <= SPEND_POLL_MIN:
+        # Solo una pausa por proyección (AdSet corriendo) queda sostenida; uno ya pausado no se marca
+        if ad.get('status') == 'ACTIVE': spend_projected[ad['id']] = (s["limit_perc"], today)
+        return True, f"proyección: cruza {s['limit_perc']:g}% en {time_to_limit:.0f}s", time_to_limit, headroom
+    return False, None, time_to_limit, headroom
+
+async def check_spend():
+    """Lee el gasto, pausa lo que rebasó o rebasará su límite antes de la próxima lectura y regresa el siguiente intervalo"""
+    tick_started = started = time.perf_counter()
+    # Estado y presupuesto vienen del snapshot: los campos base se releen en cada lectura (SWR, prioridad
+    # crítica, aparte de la descarga compartida) para ver activaciones manuales hechas en otro worker o en Ads Manager
+    refresh = None
+    if time.time() - meta_cache["parts"]["core"]["timestamp"] >= META_CACHE_TTL:
+        refresh = start_core_refresh()
+    await _poll_adset_spend()
+    if refresh: await asyncio.wait({refresh}, timeout=SPEND_POLL_MIN)
+    started = observe_since("metahandle_engine_tick_seconds", started, loop="spend", stage="meta_fetch")
+    interval = SPEND_POLL_MAX
+    transitions, reasons = [], {}
+    for ad in meta_cache["data"] or []:
+        s = schedule["adsets"].get(ad['id'])
+        if not s or s["is_frozen"] or ad['status'] != 'ACTIVE': continue
+        pause, reason, time_to_limit, headroom = stop_loss_check(ad, s)
+        if pause:
+            transitions.append((ad['id'], "PAUSED"))
+            reasons[ad['id']] = reason
+        else:
+            # Se vuelve a leer a la mitad del tiempo estimado para cruzar el límite; sin ritmo conocido
+            # (una sola muestra) el intervalo se acorta según lo que queda del límite
+            interval = min(interval, max(SPEND_POLL_MIN, time_to_limit / 2),
+                           max(SPEND_POLL_MIN, SPEND_POLL_MAX * headroom / SPEND_HEADROOM_SLOW))
+    started = observe_since("metahandle_engine_tick_seconds", started, loop="spend", stage="rules")
+    observe("metahandle_engine_transitions", len(transitions), buckets=METRICS_COUNT_BUCKETS, loop="spend")
+    await apply_engine_transitions(transitions, reasons)
+    observe_since("metahandle_engine_tick_seconds", started, loop="spend", stage="writes")
+    observe_since("metahandle_engine_tick_seconds", tick_started, loop="spend", stage="total")
+    return interval
+
+async def spend_tracker():
+    """Vigila el Stop-Loss con lecturas ligeras de gasto, más frecuentes cuanto más cerca del límite"""
+    while True:
+        interval = SPEND_POLL_MAX
+        try:
+            if schedule["automation_active"]:
+                if meta_cache["data"] is None: await get_meta_data_cached()
+                interval = await check_spend()
+        except Exception as e:
+            interval = SPEND_POLL_MIN
+            logging.error(f"Spend Tracker Error: {e}")
+        await asyncio.sleep(interval)
+
+# --- 6. ENDPOINTS DE LA API ---
 
 @app.get("/")
 async def root():
@@ -291,47 +1465,153 @@ async def root():
         "message": "Meta Control API v3.0 funcionando correctamente. Visita /docs para probar los endpoints."
     }
 
-@app.get("/ads/sync")
-async def sync_data():
-    """Sincronización central (UI)"""
-    db = SessionLocal()
-    try:
-        meta = await get_meta_data_cached()
-        settings = {s.id: {"limit_perc": s.limit_perc, "turno": s.turno, "is_frozen": s.is_frozen} for s in db.query(AdSetSetting).all()}
-        turns = {t.name: {"start": t.start_hour, "end": t.end_hour, "days": t.days} for t in db.query(TurnConfig).all()}
-        holidays = [h.date for h in db.query(HolidayConfig).all()]
+def _setting_row(s):
+    return {"limit_perc": s.limit_perc, "turno": s.turno, "is_frozen": s.is_frozen}
+
+def _turn_row(t):
+    return {"start": t.start_hour, "end": t.end_hour, "days": t.days}
+
+def _recent_logs(db):
+    logs = db.query(ActionLog).order_by(ActionLog.id.desc()).limit(15).all()
+    return [{"user": l.user, "msg": l.msg, "time": l.time.strftime("%H:%M:%S")} for l in logs]
+
+def build_sync_payload(db, meta, version, changed):
+    """Payload de sincronización: completo (changed=None) o solo lo cambiado (corre en el pool de DB)"""
+    if changed is None:
         auto = db.query(AutomationState).first()
-        logs = db.query(ActionLog).order_by(ActionLog.id.desc()).limit(15).all()
         return {
-            "meta": meta, "settings": settings, "turns": turns, "holidays": holidays,
+            "version": version, "delta": False,
+            "meta": meta,
+            "settings": {s.id: _setting_row(s) for s in db.query(AdSetSetting).all()},
+            "turns": {t.name: _turn_row(t) for t in db.query(TurnConfig).all()},
+            "holidays": [h.date for h in db.query(HolidayConfig).all()],
             "automation_active": auto.is_active if auto else False,
-            "logs": [{"user": l.user, "msg": l.msg, "time": l.time.strftime("%H:%M:%S")} for l in logs]
+            "logs": _recent_logs(db)
         }
-    finally: db.close()
+
+    payload = {"version": version, "delta": True}
+    if "meta" in changed:
+        by_id = {ad["id"]: ad for ad in meta}
+        payload["meta"] = [by_id[i] for i in changed["meta"] if i in by_id]
+        payload["meta_removed"] = [i for i in changed["meta"] if i not in by_id]
+    if "settings" in changed:
+        q = db.query(AdSetSetting)
+        if None not in changed["settings"]: q = q.filter(AdSetSetting.id.in_(changed["settings"]))
+        payload["settings"] = {s.id: _setting_row(s) for s in q.all()}
+    if "turns" in changed:
+        if None in changed["turns"]:
+            # Cambio hecho en otro worker: se manda la lista completa para que el cliente la reemplace
+            payload["turns"] = {t.name: _turn_row(t) for t in db.query(TurnConfig).all()}
+            payload["turns_replace"] = True
+        else:
+            # Los turnos borrados viajan como null
+            found = {t.name: _turn_row(t) for t in db.query(TurnConfig).filter(TurnConfig.name.in_(changed["turns"])).all()}
+            payload["turns"] = {name: found.get(name) for name in changed["turns"]}
+    if "holidays" in changed:
+        payload["holidays"] = [h.date for h in db.query(HolidayConfig).all()]
+    if "automation" in changed:
+        payload["automation_active"] = schedule["automation_active"]
+    if "logs" in changed:
+        payload["logs"] = _recent_logs(db)
+    return payload
+
+async def sync_payload(meta, since=None):
+    """Resuelve el cursor en el event loop (la bitácora no es thread-safe) y arma el payload en el pool"""
+    changed = changes_since(since) if since is not None else None
+    return await run_db(build_sync_payload, meta, sync_cursor(), changed)
+
+@app.get("/ads/sync")
+async def sync_data(request: Request, since: Optional[str] = None):
+    """Sincronización central (UI). Con If-None-Match responde 304 si nada cambió;
+    con `since=<cursor>` regresa solo lo que cambió después de ese cursor. Un cursor
+    de otro worker no coincide y recibe el payload completo."""
+    meta = await get_meta_data_cached()
+    etag = f'"{sync_cursor()}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    return JSONResponse(await sync_payload(meta, since), headers={"ETag": etag})
+
+# --- CANAL PUSH (Server-Sent Events) ---
+STREAM_KEEPALIVE = 20       # Segundos entre comentarios keep-alive para proxies
+STREAM_DEBOUNCE = 0.25      # Agrupa ráfagas de cambios en un solo mensaje
+
+# Un diff por (cursor, versión) se serializa una vez y se comparte entre todos los suscriptores
+stream_state: Dict[str, Any] = {"subscribers": 0, "refresher": None, "version": None, "payloads": {}}
+
+async def _render_stream_message(since):
+    payload = await sync_payload(meta_cache["data"] or [], since)
+    return payload["version"], f"data: {json.dumps(payload, separators=(',', ':'))}\n\n"
+
+async def _stream_message(since):
+    """Mensaje SSE serializado para un cursor, memorizado mientras la versión no cambie"""
+    if stream_state["version"] != sync_state["version"]:
+        stream_state["version"] = sync_state["version"]
+        stream_state["payloads"] = {}
+    payloads = stream_state["payloads"]
+    if since not in payloads:
+        payloads[since] = asyncio.ensure_future(_render_stream_message(since))
+    # shield: si un suscriptor se desconecta, los demás siguen esperando el mismo render
+    return await asyncio.shield(payloads[since])
+
+async def _stream_refresher():
+    """Mantiene fresco el caché de Meta mientras haya suscriptores; su costo no depende de cuántos sean"""
+    try:
+        while stream_state["subscribers"] > 0:
+            await get_meta_data_cached()
+            await asyncio.sleep(META_CACHE_TTL)
+    finally:
+        stream_state["refresher"] = None
+
+@app.get("/ads/stream")
+async def stream_updates(request: Request, since: Optional[str] = None):
+    """Canal push: envía el estado completo (o el delta desde `since`) y después cada cambio como diff"""
+    if meta_cache["data"] is None:
+        await get_meta_data_cached()
+
+    async def events():
+        cursor = since
+        stream_state["subscribers"] += 1
+        if stream_state["refresher"] is None:
+            stream_state["refresher"] = run_in_background(_stream_refresher())
+        try:
+            while not await request.is_disconnected():
+                # Se toma el evento antes de leer la versión para no perder cambios intermedios
+                changed = sync_state["changed"]
+                if cursor != sync_cursor():
+                    cursor, message = await _stream_message(cursor)
+                    yield message
+                try:
+                    await asyncio.wait_for(changed.wait(), STREAM_KEEPALIVE)
+                    await asyncio.sleep(STREAM_DEBOUNCE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+        finally:
+            stream_state["subscribers"] -= 1
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.post("/ads/meta-status")
 async def update_meta_status(req: dict):
-    res = await app.state.client.post(f"https://graph.facebook.com/{API_VERSION}/{req['id']}", params={"status": req['status'], "access_token": get_meta_token()})
+    res = await app.state.client.post(f"{META_GRAPH_URL}/{API_VERSION}/{req['id']}", params={"status": req['status']})
     if res.status_code == 200:
-        db = SessionLocal()
-        db.add(ActionLog(user=req['user'], msg=f"Manual: {req['status']} en {req['id']}"))
-        db.commit(); db.close()
-        meta_cache["timestamp"] = 0
+        log_action(req['user'], f"Manual: {req['status']} en {req['id']}", adset_id=req['id'])
+        invalidate_adset(req['id'], status=req['status'])
         return {"ok": True}
     return {"ok": False}
 
 @app.post("/ads/update")
 async def update_setting(req: dict):
     """Actualiza la DB Local"""
-    db = SessionLocal()
-    try:
+    def work(db):
         s = db.query(AdSetSetting).filter(AdSetSetting.id == req['id']).first()
         if not s: s = AdSetSetting(id=req['id']); db.add(s)
         if 'limit_perc' in req: s.limit_perc = float(req['limit_perc'])
         if 'turno' in req: s.turno = req['turno']
         if 'is_frozen' in req: s.is_frozen = bool(req['is_frozen'])
-        db.commit(); return {"ok": True}
-    finally: db.close()
+        db.commit()
+    await run_db(work)
+    mark_changed("settings", req['id']); await rebuild_schedule(); return {"ok": True}
 
 @app.post("/ads/bid")
 async def update_bid(req: dict):
@@ -340,14 +1620,12 @@ async def update_bid(req: dict):
         # Meta usa valores en su unidad base (centavos en muchas cuentas, o entero).
         # Enviaremos el valor entero que manda la interfaz.
         res = await app.state.client.post(
-            f"https://graph.facebook.com/{API_VERSION}/{req['id']}", 
-            params={"bid_amount": int(req['bid_amount']), "access_token": get_meta_token()}
+            f"{META_GRAPH_URL}/{API_VERSION}/{req['id']}", 
+            params={"bid_amount": int(req['bid_amount'])}
         )
         if res.status_code == 200:
-            db = SessionLocal()
-            db.add(ActionLog(user=req['user'], msg=f"Bid actualizado a {req['bid_amount']} en {req['id']}"))
-            db.commit(); db.close()
-            meta_cache["timestamp"] = 0 # Invalidamos caché
+            log_action(req['user'], f"Bid actualizado a {req['bid_amount']} en {req['id']}", adset_id=req['id'])
+            invalidate_adset(req['id'], bid_amount=int(req['bid_amount']))
             return {"ok": True}
         return {"ok": False, "error": res.text}
     except Exception as e:
@@ -355,118 +1633,292 @@ async def update_bid(req: dict):
 
 @app.post("/ads/bulk-update")
 async def bulk_update(req: dict):
-    db = SessionLocal()
-    try:
-        for sid in req['ids']:
-            s = db.query(AdSetSetting).filter(AdSetSetting.id == sid).first()
-            if not s: s = AdSetSetting(id=sid); db.add(s)
-            s.limit_perc = float(req['limit_perc'])
-        db.commit(); return {"ok": True}
-    finally: db.close()
+    ids, limit_perc = list(req['ids']), float(req['limit_perc'])
+    def work(db):
+        # Un solo UPDATE ... WHERE id IN (...) y un INSERT para los que aún no existen
+        existing = {i for (i,) in db.query(AdSetSetting.id).filter(AdSetSetting.id.in_(ids))}
+        db.query(AdSetSetting).filter(AdSetSetting.id.in_(ids)).update({"limit_perc": limit_perc}, synchronize_session=False)
+        db.add_all([AdSetSetting(id=sid, limit_perc=limit_perc) for sid in dict.fromkeys(ids) if sid not in existing])
+        db.commit()
+    await run_db(work)
+    for sid in ids: mark_changed("settings", sid)
+    await rebuild_schedule(); return {"ok": True}
+
+async def _current_ads(targets):
+    """Anuncios {id,name,status} por AdSet para {adset_id: target_ad_id}. El caché solo se usa si está dentro
+    de su TTL y ya conoce el anuncio destino; si no (anuncio recién creado, caché viejo) se lee el edge de Meta."""
+    await get_meta_data_cached()
+    part = meta_cache["parts"]["ads"]
+    ads = {}
+    if time.time() - part["timestamp"] < META_FIELD_GROUPS["ads"][1]:
+        for adset_id, target in targets.items():
+            rows = part["data"].get(adset_id, {}).get("ads", {}).get("data")
+            if rows is not None and any(a["id"] == target for a in rows): ads[adset_id] = rows
+    missing = [a for a in targets if a not in ads]
+    pages = await asyncio.gather(*(
+        fetch_all_pages(f"{META_GRAPH_URL}/{API_VERSION}/{a}/ads", {"fields": "id,name,status", "limit": "100"}) for a in missing
+    ), return_exceptions=True)
+    for adset_id, rows in zip(missing, pages):
+        if isinstance(rows, Exception):
+            logging.error(f"Error leyendo anuncios de {adset_id}: {rows}")
+            continue
+        ads[adset_id] = rows
+    return ads
+
+async def rotate_media(rotations, user):
+    """Deja un solo anuncio activo por AdSet para cada {adset_id, target_ad_id}. El encendido del destino se
+    manda siempre (el caché puede estar viejo); el caché solo sirve para no apagar lo que ya no está activo.
+    Los anteriores se apagan únicamente después de que Meta confirmó el encendido (nunca queda un AdSet sin
+    anuncios activos) y se regresa el resultado por anuncio."""
+    targets = {str(r["adset_id"]): str(r["target_ad_id"]) for r in rotations}
+    current = await _current_ads(targets)
+    results = {}
+    for adset_id, target in targets.items():
+        ads = current.get(adset_id)
+        if ads is None:
+            results[adset_id] = {"ok": False, "error": "No se pudieron leer los anuncios", "ads": {}}
+        elif target not in {a["id"] for a in ads}:
+            results[adset_id] = {"ok": False, "error": f"El anuncio {target} no pertenece al AdSet", "ads": {}}
+        else:
+            entries = {}
+            for a in ads:
+                # Solo se apagan los que están corriendo; PAUSED/ARCHIVED/DELETED quedan igual
+                if a["id"] == target:
+                    entries[a["id"]] = {"status": "ACTIVE", "result": "pending"}
+                elif a.get("status") == "ACTIVE":
+                    entries[a["id"]] = {"status": "PAUSED", "result": "pending"}
+                else:
+                    entries[a["id"]] = {"status": a.get("status"), "result": "skipped"}
+            results[adset_id] = {"ok": True, "ads": entries}
+
+    # 1. Encendidos de todos los AdSets en las mismas llamadas batch
+    activations = [(t, "ACTIVE") for a, t in targets.items() if results[a]["ok"]]
+    done = await apply_status_transitions(activations) if activations else {}
+
+    # 2. Apagados solo donde el destino ya quedó activo
+    pauses = []
+    for adset_id, target in targets.items():
+        r = results[adset_id]
+        if not r["ok"]: continue
+        if not done.get(target):
+            r.update(ok=False, error="No se pudo activar el anuncio destino")
+            for e in r["ads"].values():
+                if e["result"] == "pending": e["result"] = "not_attempted"
+            r["ads"][target]["result"] = "failed"
+            continue
+        r["ads"][target]["result"] = "ok"
+        pauses += [(ad_id, "PAUSED") for ad_id, e in r["ads"].items() if e["result"] == "pending"]
+    if pauses: done.update(await apply_status_transitions(pauses))
+
+    for adset_id, target in targets.items():
+        r = results[adset_id]
+        for ad_id, e in r["ads"].items():
+            if e["result"] == "pending":
+                e["result"] = "ok" if done.get(ad_id) else "failed"
+                if not done.get(ad_id): r.update(ok=False, error="No se pudieron apagar todos los anuncios anteriores")
+        written = {ad_id: e["status"] for ad_id, e in r["ads"].items() if e["result"] == "ok"}
+        if written:
+            # Lo confirmado por Meta se refleja en el caché sin volver a leer el AdSet
+            patch_cached_adset(adset_id, {"ads": {"data": [dict(a, status=written.get(a["id"], a.get("status"))) for a in current[adset_id]]}})
+            log_action(user, f"Rotó medios. Activo: {target}" + ("" if r["ok"] else " (con errores)"), adset_id=adset_id)
+        r["ads"] = [{"id": ad_id, **e} for ad_id, e in r["ads"].items()]
+    return results
 
 @app.post("/ads/medios/toggle")
 async def toggle_media(req: dict):
-    """Apaga el anuncio B y enciende el anuncio A para rotación segura"""
-    adset_id = req.get("adset_id")
-    target_ad_id = req.get("target_ad_id")
-    
-    # 1. Traer todos los Ads del AdSet
-    url = f"https://graph.facebook.com/{API_VERSION}/{adset_id}/ads"
-    token = get_meta_token()
+    """Enciende el anuncio A y apaga los demás del AdSet para rotación segura"""
     try:
-        res = await app.state.client.get(url, params={"fields": "id", "access_token": token})
-        ads = res.json().get("data", [])
-        
-        # 2. Apagar los que NO sean el target_ad_id, encender el target
-        for ad in ads:
-            status = "ACTIVE" if str(ad["id"]) == str(target_ad_id) else "PAUSED"
-            await app.state.client.post(
-                f"https://graph.facebook.com/{API_VERSION}/{ad['id']}", 
-                params={"status": status, "access_token": token}
-            )
-        
-        db = SessionLocal()
-        db.add(ActionLog(user=req['user'], msg=f"Rotó medios. Activo: {target_ad_id}"))
-        db.commit(); db.close()
-        meta_cache["timestamp"] = 0 # Limpia caché para reflejar visualmente
-        return {"ok": True}
+        return (await rotate_media([req], req['user']))[str(req.get("adset_id"))]
     except Exception as e:
         return {"ok": False, "error": str(e)}
 
+@app.post("/ads/medios/rotate")
+async def rotate_media_bulk(req: dict):
+    """Rotación masiva: `rotations` = [{adset_id, target_ad_id}]. Regresa el resultado por AdSet y por anuncio."""
+    rotations = req.get("rotations") or []
+    if not rotations: raise HTTPException(400, "Sin rotaciones")
+    try:
+        results = await rotate_media(rotations, req['user'])
+    except Exception as e:
+        return {"ok": False, "error": str(e)}
+    return {"ok": all(r["ok"] for r in results.values()), "results": results}
+
+LOGS_PAGE_MAX = 500
+
+@app.get("/logs")
+async def query_logs(before: Optional[int] = None, limit: int = 50, user: Optional[str] = None,
+                     adset_id: Optional[str] = None, since: Optional[str] = None, until: Optional[str] = None):
+    """Bitácora paginada por cursor (id descendente). `next_before` se manda como `before` para la siguiente
+    página; `since`/`until` son fechas ISO en UTC."""
+    try:
+        since_dt = datetime.fromisoformat(since) if since else None
+        until_dt = datetime.fromisoformat(until) if until else None
+    except ValueError:
+        raise HTTPException(400, "Fecha inválida")
+    limit = max(1, min(limit, LOGS_PAGE_MAX))
+
+    def work(db):
+        q = db.query(ActionLog)
+        if before is not None: q = q.filter(ActionLog.id < before)
+        if user: q = q.filter(ActionLog.user == user)
+        if adset_id: q = q.filter(ActionLog.adset_id == adset_id)
+        if since_dt: q = q.filter(ActionLog.time >= since_dt)
+        if until_dt: q = q.filter(ActionLog.time < until_dt)
+        return [
+            {"id": l.id, "user": l.user, "msg": l.msg, "adset_id": l.adset_id, "reason": l.reason, "time": l.time.isoformat()}
+            for l in q.order_by(ActionLog.id.desc()).limit(limit).all()
+        ]
+
+    logs = await run_db(work)
+    return {"logs": logs, "next_before": logs[-1]["id"] if len(logs) == limit else None}
+
+@app.get("/ads/cache/stats")
+async def cache_stats():
+    """Contadores del caché de Meta (aciertos, fallos y latencia de refresco)"""
+    stats = meta_cache["stats"]
+    return {
+        **stats,
+        "refresh_ms_avg": stats["refresh_ms_total"] / stats["refreshes"] if stats["refreshes"] else 0.0,
+        "age_s": time.time() - meta_cache["timestamp"] if meta_cache["data"] is not None else None,
+        "refreshing": meta_cache["refresh"] is not None,
+    }
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Métricas en formato de texto Prometheus (por worker)"""
+    stats = meta_cache["stats"]
+    lookups = stats["hits"] + stats["stale_hits"] + stats["misses"]
+    client = app.state.client
+    samples = [
+        ("metahandle_meta_cache_requests_total", {"result": "hit"}, stats["hits"]),
+        ("metahandle_meta_cache_requests_total", {"result": "stale"}, stats["stale_hits"]),
+        ("metahandle_meta_cache_requests_total", {"result": "miss"}, stats["misses"]),
+        ("metahandle_meta_cache_refreshes_total", {}, stats["refreshes"]),
+        ("metahandle_meta_cache_refresh_errors_total", {}, stats["errors"]),
+        ("metahandle_meta_cache_hit_ratio", {}, (stats["hits"] + stats["stale_hits"]) / lookups if lookups else 0.0),
+        ("metahandle_meta_usage_percent", {}, client.usage_pct),
+        ("metahandle_meta_rate", {}, client.rate),
+        ("metahandle_meta_queue_length", {}, len(client.queue)),
+        ("metahandle_log_buffer_entries", {}, len(log_buffer)),
+        ("metahandle_stream_subscribers", {}, stream_state["subscribers"]),
+        ("metahandle_automation_active", {}, int(schedule["automation_active"])),
+        ("metahandle_engine_leader", {}, int(cluster_state["leader"])),
+    ]
+    now = time.time()
+    for group, part in meta_cache["parts"].items():
+        if part["timestamp"]: samples.append(("metahandle_meta_cache_age_seconds", {"group": group}, now - part["timestamp"]))
+    return Response(render_metrics(samples), media_type="text/plain; version=0.0.4")
+
 # --- ENDPOINTS GESTIÓN FECHAS FESTIVAS ---
 @app.post("/holidays/add")
 async def add_holiday(req: dict):
-    db = SessionLocal()
-    try:
-        if not db.query(HolidayConfig).filter_by(date=req['date']).first():
-            db.add(HolidayConfig(date=req['date']))
-            db.commit()
-        return {"ok": True}
-    finally: db.close()
+    def work(db):
+        if db.query(HolidayConfig).filter_by(date=req['date']).first(): return False
+        db.add(HolidayConfig(date=req['date']))
+        db.commit()
+        return True
+    if await run_db(work):
+        mark_changed("holidays")
+        await rebuild_schedule()
+    return {"ok": True}
 
 @app.post("/holidays/delete")
 async def delete_holiday(req: dict):
-    db = SessionLocal()
-    try:
+    def work(db):
         h = db.query(HolidayConfig).filter_by(date=req['date']).first()
-        if h:
-            db.delete(h)
-            db.commit()
-        return {"ok": True}
-    finally: db.close()
+        if not h: return False
+        db.delete(h)
+        db.commit()
+        return True
+    if await run_db(work):
+        mark_changed("holidays")
+        await rebuild_schedule()
+    return {"ok": True}
 
 # --- ENDPOINTS AUTENTICACIÓN Y EXTRAS ---
 @app.post("/turns/update")
 async def update_turn(req: dict):
-    db = SessionLocal()
-    try:
+    def work(db):
         t = db.query(TurnConfig).filter(TurnConfig.name == req['name']).first()
         if not t: t = TurnConfig(name=req['name']); db.add(t)
         t.start_hour, t.end_hour, t.days = float(req['start']), float(req['end']), req['days']
-        db.commit(); return {"ok": True}
-    finally: db.close()
+        db.commit()
+    await run_db(work)
+    mark_changed("turns", req['name']); await rebuild_schedule(); return {"ok": True}
 
 @app.post("/turns/delete")
 async def delete_turn(req: dict):
-    db = SessionLocal()
-    try:
+    def work(db):
         t = db.query(TurnConfig).filter(TurnConfig.name == req['name']).first()
-        if t and t.name.lower() not in ["matutino", "especial", "vespertino", "nocturno", "fsemana"]:
-            db.delete(t)
-            db.commit()
-            return {"ok": True}
-        return {"ok": False}
-    finally: db.close()
+        if not t or t.name.lower() in ["matutino", "especial", "vespertino", "nocturno", "fsemana"]: return False
+        db.delete(t)
+        db.commit()
+        return True
+    if await run_db(work):
+        mark_changed("turns", req['name'])
+        await rebuild_schedule()
+        return {"ok": True}
+    return {"ok": False}
+
+@app.post("/schedule/simulate")
+async def simulate_schedule(req: dict):
+    """Vista previa de horarios: línea de tiempo por AdSet entre `start` y `end` (YYYY-MM-DD, inclusive; por
+    defecto 7 días desde hoy) con la configuración guardada más los cambios propuestos, sin guardarlos"""
+    now = datetime.now(MEX_TZ)
+    try:
+        start = datetime.strptime(req.get("start") or now.strftime('%Y-%m-%d'), '%Y-%m-%d').date()
+        end = datetime.strptime(req["end"], '%Y-%m-%d').date() if req.get("end") else start + timedelta(days=6)
+    except ValueError:
+        raise HTTPException(400, "Fecha inválida")
+    if end < start or (end - start).days >= SIMULATION_MAX_DAYS:
+        raise HTTPException(400, f"Rango inválido (máximo {SIMULATION_MAX_DAYS} días)")
+    ids = req.get("ids") or ALLOWED_IDS
+    if not isinstance(ids, list) or not all(isinstance(i, str) for i in ids):
+        raise HTTPException(400, "ids debe ser una lista de IDs de AdSet")
+    # compute_ms cubre lectura de la configuración, compilación y línea de tiempo
+    started = time.perf_counter()
+    try:
+        compiled = await run_db(_simulation_schedule, req)
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        raise HTTPException(400, f"Cambios propuestos inválidos: {e}")
+    adsets = simulate_timeline(compiled, start, end, ids, now)
+    return {
+        "start": start.isoformat(), "end": end.isoformat(), "timezone": MEX_TZ.zone,
+        "automation_active": compiled["automation_active"],
+        "compute_ms": round((time.perf_counter() - started) * 1000, 2), "adsets": adsets,
+    }
 
 @app.post("/ads/automation/toggle")
 async def toggle_auto(req: dict):
-    db = SessionLocal()
-    try:
+    def work(db):
         auto = db.query(AutomationState).first()
         auto.is_active = not auto.is_active
-        db.add(ActionLog(user=req['user'], msg=f"{'Encendió' if auto.is_active else 'Apagó'} automatización"))
-        db.commit(); return {"is_active": auto.is_active}
-    finally: db.close()
+        db.commit()
+        return auto.is_active
+    is_active = await run_db(work)
+    log_action(req['user'], f"{'Encendió' if is_active else 'Apagó'} automatización")
+    await rebuild_schedule()
+    mark_changed("automation")
+    return {"is_active": is_active}
 
 @app.get("/auth/auditors")
 async def get_auditors():
-    creds = get_google_creds()
-    if not creds: return {"auditors": ["Auditor Maestro"]}
-    try:
-        service = build('sheets', 'v4', credentials=creds)
-        res = service.spreadsheets().values().get(spreadsheetId=SHEET_ID, range="Auditores!A:B").execute()
-        return {"auditors": [row[0] for row in res.get('values', [])[1:] if row]}
-    except: return {"auditors": ["Error DB"]}
+    if not auditor_directory["loaded"]:
+        await load_auditors()
+        if not auditor_directory["loaded"]:
+            return {"auditors": ["Error DB" if get_google_creds() else "Auditor Maestro"]}
+    return {"auditors": auditor_directory["names"]}
 
 @app.post("/auth/login")
 async def login(req: dict):
-    creds = get_google_creds()
-    if not creds: raise HTTPException(401, "Config error")
-    try:
-        service = build('sheets', 'v4', credentials=creds)
-        res = service.spreadsheets().values().get(spreadsheetId=SHEET_ID, range="Auditores!A:B").execute()
-        for row in res.get('values', [])[1:]:
-            if row[0] == req['nombre'] and str(row[1]) == str(req['password']):
-                return {"user": row[0]}
-        raise HTTPException(401, "Inválido")
-    except: raise HTTPException(500, "Error")
\ No newline at end of file
+    if not auditor_directory["loaded"]:
+        await load_auditors()
+        if not auditor_directory["loaded"]:
+            if not get_google_creds(): raise HTTPException(401, "Config error")
+            raise HTTPException(500, "Error")
+    candidate = _hash_password(req['password'])
+    # compare_digest en todas las entradas: el tiempo no revela cuál coincidió
+    matches = [hmac.compare_digest(candidate, h) for h in auditor_directory["hashes"].get(req['nombre'], [])]
+    if any(matches):
+        return {"user": req['nombre']}
+    raise HTTPException(401, "Inválido")
@@ -0,0 +1,224 @@
+"""Servidor simulado de la Graph API de Meta para pruebas de carga y benchmarks.
+
+Atiende las mismas rutas que usa main.py (?ids=, /{adset}, /{adset}/ads, /{cuenta}/insights,
+POST de estado/puja y Batch API) con N AdSets y M anuncios por AdSet, latencia, tasa de errores
+y headers de uso (X-App-Usage) configurables.
+
+Uso:
+    python mock_graph.py --adsets 200 --ads 5 --latency-ms 80 --error-rate 0.01 --usage 30 --port 8900
+    META_GRAPH_URL=http://127.0.0.1:8900 uvicorn main:app
+
+Durante la corrida se puede cambiar la configuración con POST /_mock/config y consultar
+contadores con GET /_mock/stats.
+"""
+import re
+import json
+import time
+import random
+import asyncio
+import argparse
+from collections import Counter, deque
+from urllib.parse import parse_qsl, urlencode
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+DEFAULT_CONFIG = {
+    "adsets": 50,           # AdSets simulados
+    "ads": 3,               # Anuncios por AdSet
+    "latency_ms": 50.0,     # Latencia media por petición (±20% de jitter)
+    "error_rate": 0.0,      # Probabilidad de responder 500 (code 2) por petición o por elemento batch
+    "throttle_rate": 0.0,   # Probabilidad de responder throttling (code 17)
+    "usage": 10.0,          # % base reportado en X-App-Usage
+    "quota": 0,             # Llamadas por minuto que equivalen a 100% de uso (0 = solo el % base)
+    "spend_rate": 0.01,     # Gasto simulado por AdSet en moneda/segundo
+    "daily_budget": 50000,  # Presupuesto diario en centavos
+}
+
+ADSET_PREFIX = "9000000"
+AD_PREFIX = "8000000"
+
+def adset_ids(n):
+    return [f"{ADSET_PREFIX}{i:06d}" for i in range(n)]
+
+def _top_level_fields(fields):
+    """'id,insights.date_preset(today){spend},ads.limit(100){id}' -> {'id': '', 'insights': '...', 'ads': '...'}"""
+    out, depth, cur = {}, 0, ""
+    for ch in (fields or "") + ",":
+        if ch in "({": depth += 1
+        elif ch in ")}": depth -= 1
+        if ch == "," and depth == 0:
+            if cur.strip():
+                name = re.split(r"[.{]", cur.strip(), maxsplit=1)[0]
+                out[name] = cur.strip()
+            cur = ""
+        else:
+            cur += ch
+    return out
+
+def create_app(**overrides):
+    """Construye la app simulada; `overrides` reemplaza valores de DEFAULT_CONFIG"""
+    app = FastAPI()
+    cfg = dict(DEFAULT_CONFIG, **overrides)
+    state = {"adsets": {}, "ads": {}, "started": time.time(), "calls": deque(), "stats": Counter()}
+    app.state.cfg, app.state.mock = cfg, state
+
+    def populate(status="ACTIVE"):
+        state["adsets"], state["ads"], state["started"] = {}, {}, time.time()
+        for i, adset_id in enumerate(adset_ids(cfg["adsets"])):
+            ads = [f"{AD_PREFIX}{i:06d}{k:03d}" for k in range(cfg["ads"])]
+            state["adsets"][adset_id] = {
+                "id": adset_id, "name": f"Mock AdSet {i}", "status": status,
+                "daily_budget": str(cfg["daily_budget"]), "bid_amount": 100, "issues_info": [], "ads": ads,
+            }
+            for k, ad_id in enumerate(ads):
+                state["ads"][ad_id] = {"id": ad_id, "name": f"Mock Ad {i}-{k}", "status": "ACTIVE" if k == 0 else "PAUSED"}
+
+    populate()
+
+    def spend(adset_id):
+        return round(cfg["spend_rate"] * (time.time() - state["started"]), 2)
+
+    def usage_pct():
+        now = time.time()
+        calls = state["calls"]
+        while calls and now - calls[0] > 60: calls.popleft()
+        pct = float(cfg["usage"])
+        if cfg["quota"]: pct = max(pct, 100.0 * len(calls) / cfg["quota"])
+        return min(pct, 100.0)
+
+    def ads_page(request, adset_id, after, limit):
+        ads = state["adsets"][adset_id]["ads"]
+        page = {"data": [state["ads"][a] for a in ads[after:after + limit]]}
+        if after + limit < len(ads):
+            base = f"{str(request.base_url).rstrip('/')}/{request.path_params['version']}"
+            page["paging"] = {"next": f"{base}/{adset_id}/ads?after={after + limit}&limit={limit}&access_token=mock"}
+        return page
+
+    def render(request, adset_id, fields):
+        adset = state["adsets"][adset_id]
+        out = {}
+        for name, spec in _top_level_fields(fields).items():
+            if name == "insights":
+                out["insights"] = {"data": [{"spend": f"{spend(adset_id):.2f}", "actions": []}]}
+            elif name == "ads":
+                m = re.search(r"limit\((\d+)\)", spec)
+                out["ads"] = ads_page(request, adset_id, 0, int(m.group(1)) if m else 25)
+            elif name in adset:
+                out[name] = adset[name]
+        return out
+
+    def error(code, message, status=500):
+        return JSONResponse({"error": {"code": code, "message": message, "type": "OAuthException"}}, status_code=status)
+
+    def update_node(node_id, params):
+        node = state["adsets"].get(node_id) or state["ads"].get(node_id)
+        if not node: return False
+        if "status" in params: node["status"] = params["status"]
+        if "bid_amount" in params: node["bid_amount"] = int(params["bid_amount"])
+        state["stats"]["writes"] += 1
+        return True
+
+    @app.middleware("http")
+    async def simulate(request: Request, call_next):
+        """Latencia, errores aleatorios y headers de uso como los de Graph"""
+        if request.url.path.startswith("/_mock"):
+            return await call_next(request)
+        state["calls"].append(time.time())
+        state["stats"]["requests"] += 1
+        await asyncio.sleep(cfg["latency_ms"] / 1000 * random.uniform(0.8, 1.2))
+        pct = usage_pct()
+        headers = {"x-app-usage": json.dumps({"call_count": pct, "total_cputime": pct / 2, "total_time": pct / 2})}
+        roll = random.random()
+        if pct >= 100 or roll < cfg["throttle_rate"]:
+            state["stats"]["throttled"] += 1
+            res = error(17, "User request limit reached", 400)
+            headers["x-business-use-case-usage"] = json.dumps({"act_mock": [{"call_count": pct, "estimated_time_to_regain_access": 0}]})
+        elif roll < cfg["throttle_rate"] + cfg["error_rate"]:
+            state["stats"]["errors"] += 1
+            res = error(2, "Service temporarily unavailable")
+        else:
+            res = await call_next(request)
+        res.headers.update(headers)
+        return res
+
+    @app.get("/_mock/stats")
+    async def mock_stats():
+        return {"config": cfg, "usage_pct": usage_pct(), **state["stats"]}
+
+    @app.post("/_mock/config")
+    async def mock_config(req: dict):
+        cfg.update({k: v for k, v in req.items() if k in cfg})
+        if "adsets" in req or "ads" in req: populate()
+        return cfg
+
+    @app.post("/_mock/reset")
+    async def mock_reset(req: dict):
+        """Reinicia gasto y contadores; opcionalmente fuerza el estado de todos los AdSets"""
+        populate(req.get("status", "ACTIVE"))
+        state["stats"].clear()
+        return {"ok": True}
+
+    @app.post("/")
+    async def batch(request: Request):
+        form = dict(parse_qsl((await request.body()).decode()))
+        state["stats"]["batch"] += 1
+        replies = []
+        for item in json.loads(form.get("batch", "[]")):
+            node_id = item["relative_url"].split("?")[0].rstrip("/").rsplit("/", 1)[-1]
+            if random.random() < cfg["error_rate"]:
+                replies.append({"code": 500, "body": json.dumps({"error": {"code": 2, "message": "Service temporarily unavailable"}})})
+            elif update_node(node_id, dict(parse_qsl(item.get("body", "")))):
+                replies.append({"code": 200, "body": json.dumps({"success": True})})
+            else:
+                replies.append({"code": 400, "body": json.dumps({"error": {"code": 100, "message": f"Unknown object {node_id}"}})})
+        return replies
+
+    @app.get("/{version}/")
+    async def get_ids(request: Request, version: str, ids: str = "", fields: str = "id"):
+        state["stats"]["ids"] += 1
+        wanted = [i for i in ids.split(",") if i]
+        if len(wanted) > 50: return error(100, "Too many IDs. Maximum: 50", 400)
+        return {i: render(request, i, fields) for i in wanted if i in state["adsets"]}
+
+    @app.get("/{version}/{node_id}/ads")
+    async def get_ads(request: Request, version: str, node_id: str, after: int = 0, limit: int = 25):
+        state["stats"]["ads"] += 1
+        if node_id not in state["adsets"]: return error(100, f"Unknown object {node_id}", 400)
+        return ads_page(request, node_id, after, limit)
+
+    @app.get("/{version}/{account_id}/insights")
+    async def get_insights(request: Request, version: str, account_id: str, after: int = 0, limit: int = 25, filtering: str = "[]"):
+        state["stats"]["insights"] += 1
+        wanted = next((f["value"] for f in json.loads(filtering) if f.get("field") == "adset.id"), list(state["adsets"]))
+        rows = [{"adset_id": i, "spend": f"{spend(i):.2f}"} for i in wanted if i in state["adsets"]]
+        page = {"data": rows[after:after + limit]}
+        if after + limit < len(rows):
+            query = urlencode({"after": after + limit, "limit": limit, "filtering": filtering, "access_token": "mock"})
+            page["paging"] = {"next": f"{str(request.base_url).rstrip('/')}/{version}/{account_id}/insights?{query}"}
+        return page
+
+    @app.get("/{version}/{node_id}")
+    async def get_node(request: Request, version: str, node_id: str, fields: str = "id"):
+        state["stats"]["node"] += 1
+        if node_id in state["ads"]: return state["ads"][node_id]
+        if node_id not in state["adsets"]: return error(100, f"Unknown object {node_id}", 400)
+        return render(request, node_id, fields)
+
+    @app.post("/{version}/{node_id}")
+    async def post_node(request: Request, version: str, node_id: str):
+        params = dict(request.query_params)
+        params.update(parse_qsl((await request.body()).decode()))
+        if not update_node(node_id, params): return error(100, f"Unknown object {node_id}", 400)
+        return {"success": True}
+
+    return app
+
+if __name__ == "__main__":
+    import uvicorn
+    parser = argparse.ArgumentParser(description="Graph API simulada para pruebas de carga")
+    for key, value in DEFAULT_CONFIG.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=type(value), default=value)
+    parser.add_argument("--port", type=int, default=8900)
+    args = vars(parser.parse_args())
+    port = args.pop("port")
+    uvicorn.run(create_app(**args), host="127.0.0.1", port=port, log_level="warning")